@@ -0,0 +1,236 @@
+"""
+Timings of the training hot paths on synthetic 128-byte RAM observations, no gym needed.
+
+    python -m benchmarks --out results.json
+    python -m benchmarks --out new.json --compare results.json
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+from time import perf_counter
+
+import numpy as np
+import torch
+
+from dreamerv2.dataset import ModelDataset, SequenceSampler
+from dreamerv2.model import WorldModel, Actor, Critic, LossModel, ActorLoss, CriticLoss, lambda_returns
+from dreamerv2.preprocess import Preprocessor
+from dreamerv2.replay import ReplayBuffer
+
+OBS_SHAPE = (128,)
+NUM_ACTIONS = 18
+GAMMA = 0.995
+LAMB = 0.95
+
+def fill_replay(capacity=2**16, episode_length=500):
+    # random bytes stored as uint8 like real observations
+    replay = ReplayBuffer(capacity, OBS_SHAPE, NUM_ACTIONS, obs_dtype=np.uint8)
+    rng = np.random.default_rng(0)
+    while replay.used + episode_length + 1 <= capacity:
+        T = episode_length
+        obs = rng.integers(0, 256, size=(T+1, *OBS_SHAPE), dtype=np.uint8)
+        dones = np.zeros(T, dtype=np.bool_)
+        dones[-1] = True
+        replay.add_episode(obs, rng.integers(0, NUM_ACTIONS, size=T), rng.standard_normal(T).astype(np.float32), dones)
+    return replay
+
+def time_fn(fn, repeat, warmup):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        times.append(perf_counter() - start)
+    return {
+        "median_ms": 1000 * statistics.median(times),
+        "mean_ms": 1000 * statistics.fmean(times),
+        "min_ms": 1000 * min(times),
+        "repeat": repeat,
+    }
+
+def bench_dataset(replay, batch, L):
+    # a DataLoader batch of ModelDataset samples without the worker overhead
+    dataset = ModelDataset(replay, L, GAMMA, history_size=batch)
+    def run():
+        samples = [dataset[i] for i in range(batch)]
+        return [torch.stack(field) for field in zip(*samples)]
+    return run
+
+def bench_sampler(replay, batch, L):
+    sampler = SequenceSampler(replay, batch, L, GAMMA)
+    return sampler.sample
+
+def bench_world_model(replay, batch, L):
+    # forward, loss and backward of the observed sequence
+    world = WorldModel(GAMMA, NUM_ACTIONS)
+    criterion = LossModel()
+    optim = torch.optim.Adam(world.parameters(), lr=2e-4)
+    s, a, r, g = (t.clone() for t in SequenceSampler(replay, batch, L, GAMMA).sample())
+    preprocess = Preprocessor()
+    def run():
+        x = preprocess.to_float(s)
+        z_logits, z_sample, z_hat_logits, x_hat, r_hat, gamma_hat, _ = world.observe(x, a)
+        # step t predicts the reward and discount of transition t-1
+        loss, _ = criterion(x, r, g, z_logits, z_sample, x_hat, r_hat[:, 1:], gamma_hat[:, 1:], z_hat_logits)
+        loss.backward()
+        optim.step()
+        optim.zero_grad()
+    return run
+
+def latents(N):
+    z = torch.zeros(N, 32, 32)
+    z.scatter_(2, torch.randint(0, 32, (N, 32, 1)), 1)
+    return z.reshape(N, 32*32), torch.randn(N, 512)
+
+def bench_imagine(N, H):
+    world = WorldModel(GAMMA, NUM_ACTIONS)
+    actor = Actor(NUM_ACTIONS)
+    z, h = latents(N)
+    def run():
+        out = world.imagine(actor, z, h, H)
+        (out[3].float().mean() + out[0].float().mean()).backward()
+        world.zero_grad()
+        actor.zero_grad()
+    return run
+
+def bench_imagine_compact(N, H):
+    # same rollout with int16 latents and gather-sum input layers
+    world = WorldModel(GAMMA, NUM_ACTIONS)
+    actor = Actor(NUM_ACTIONS)
+    z, h = latents(N)
+    def run():
+        out = world.imagine_compact(actor, z, h, H)
+        (out[4].float().mean() + out[1].float().mean()).backward()
+        world.zero_grad()
+        actor.zero_grad()
+    return run
+
+def bench_returns(N, H):
+    # target and critic forwards, lambda-returns, both losses and their backward
+    critic, target = Critic(), Critic()
+    criterion_actor, criterion_critic = ActorLoss(), CriticLoss()
+    z = torch.zeros(H+1, N, 32*32)
+    z.view(H+1, N, 32, 32).scatter_(3, torch.randint(0, 32, (H+1, N, 32, 1)), 1)
+    a_logits = torch.randn(H, N, NUM_ACTIONS, requires_grad=True)
+    a = torch.nn.functional.one_hot(a_logits.argmax(-1), NUM_ACTIONS).float()
+    rewards = torch.randn(H, N, 1)
+    discounts = torch.full((H, N, 1), GAMMA)
+    def run():
+        values = target(z[1:].reshape(H*N, -1)).reshape(H, N, 1)
+        ve = critic(z[:-1].reshape(H*N, -1)).reshape(H, N, 1)
+        V = lambda_returns(rewards, discounts, values, values[-1], LAMB)
+        loss = criterion_critic(V.detach(), ve) + criterion_actor(a, a_logits, V, ve.detach())
+        loss.backward()
+        critic.zero_grad()
+        target.zero_grad()
+    return run
+
+def bench_preprocess(N):
+    # one collector step of raw Atari frames to stored 64x64 grayscale
+    preprocess = Preprocessor(pixels=True)
+    frames = np.random.randint(0, 256, size=(N, 210, 160, 3), dtype=np.uint8)
+    return lambda: preprocess(frames)
+
+def bench_inference(N):
+    # one collector step: posterior update and action
+    world = WorldModel(GAMMA, NUM_ACTIONS)
+    actor = Actor(NUM_ACTIONS)
+    x = Preprocessor().transform(np.random.randint(0, 256, size=(N, *OBS_SHAPE), dtype=np.uint8))
+    a = torch.zeros(N, NUM_ACTIONS)
+    z, h = latents(N)
+    def run():
+        with torch.no_grad():
+            z_sample, _ = world.forward_inference(a, x, z, h)
+            actor(z_sample)
+    return run
+
+def run_suite(args):
+    torch.manual_seed(0)
+    np.random.seed(0)
+    batch, L, H = args.batch, args.L, args.H
+    replay = fill_replay()
+    N = batch * (L+1) # dreams start from every posterior of the batch
+
+    cases = {
+        "dataset_batch": lambda: bench_dataset(replay, batch, L),
+        "sampler_batch": lambda: bench_sampler(replay, batch, L),
+        "world_model_pass": lambda: bench_world_model(replay, batch, L),
+        "imagine": lambda: bench_imagine(N, H),
+        "imagine_compact": lambda: bench_imagine_compact(N, H),
+        "returns_and_losses": lambda: bench_returns(N, H),
+        "preprocess_frames": lambda: bench_preprocess(16),
+    }
+    for n in args.inference_batch_sizes:
+        cases["inference_n%d" % n] = lambda n=n: bench_inference(n)
+
+    results = {}
+    for name, make in cases.items():
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = time_fn(make(), args.repeat, args.warmup)
+        print ("%-22s %10.3f ms" % (name, results[name]["median_ms"]), file=sys.stderr)
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the median of every case against the baseline, returns the names of the
+    cases that got slower by more than tolerance.
+    """
+    regressions = []
+    print ("%-22s %12s %12s %8s" % ("case", "baseline ms", "current ms", "ratio"))
+    for name, result in results.items():
+        if name not in baseline:
+            print ("%-22s %12s %12.3f" % (name, "-", result["median_ms"]))
+            continue
+        ratio = result["median_ms"] / baseline[name]["median_ms"]
+        flag = ""
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print ("%-22s %12.3f %12.3f %8.2f%s" % (name, baseline[name]["median_ms"], result["median_ms"], ratio, flag))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="benchmarks", description="Benchmark the DreamerV2 hot paths on CPU")
+    parser.add_argument("--out", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown before a case counts as regression")
+    parser.add_argument("--filter", help="only run cases whose name contains this")
+    parser.add_argument("--batch", type=int, default=16)
+    parser.add_argument("--L", type=int, default=50)
+    parser.add_argument("--H", type=int, default=15)
+    parser.add_argument("--inference_batch_sizes", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--threads", type=int, help="torch intra-op threads")
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    report = {
+        "meta": {
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "threads": torch.get_num_threads(),
+            "batch": args.batch, "L": args.L, "H": args.H,
+        },
+        "results": run_suite(args),
+    }
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if {k: baseline["meta"].get(k) for k in ("batch", "L", "H")} != {k: report["meta"][k] for k in ("batch", "L", "H")}:
+            print ("warning: baseline was run with different sizes", file=sys.stderr)
+        if compare(report["results"], baseline["results"], args.tolerance):
+            sys.exit(1)
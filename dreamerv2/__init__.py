@@ -0,0 +1,10 @@
+from .config import Config
+
+__all__ = ["Config", "Trainer"]
+
+def __getattr__(name):
+    # torch and the models are only imported once training is actually set up
+    if name == "Trainer":
+        from .train import Trainer
+        return Trainer
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,10 @@
+from .config import Config
+
+def main(argv=None):
+    config = Config.from_args(argv)
+    from .distributed import launch
+    launch(config)
+
+# collector processes are spawned and import the main module again
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import glob
+import os
+import threading
+
+import numpy as np
+import torch
+
+from .replay import EpisodeStore
+
+def snapshot(state):
+    """
+    Copy of a (nested) state with every tensor detached and copied to CPU.
+    """
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {k: snapshot(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(v) for v in state)
+    return state
+
+class CheckpointManager:
+    """
+    Saves checkpoints without stalling training. The state is copied to CPU on the
+    calling thread, then serialized from a background thread to a temp file that is
+    atomically renamed, so a crash never leaves a corrupt checkpoint behind. Only the
+    last `keep` checkpoints are kept, and none are written with keep=0.
+
+    Checkpoints are named checkpoint-<save>-<iternum>.chkpt and ordered by save, a
+    counter that grows with every write of this directory, so the latest one is the
+    one written last even when iternum went backwards. Names of older versions,
+    checkpoint-<iternum>.chkpt, come before every numbered save.
+
+    A ReplayBuffer can be persisted alongside, one .npz per episode: every save only
+    writes the episodes added since the previous one and deletes the evicted ones.
+    An EpisodeStore is already on disk and is only flushed. For both, the latest
+    snapshot of the episodes still being collected replaces the previous one, and
+    restore_pending adds those to the replay as truncated episodes after a restart.
+    """
+    def __init__(self, directory, keep=3, replay_name="replay"):
+        self.directory = directory
+        self.replay_dir = os.path.join(directory, replay_name)
+        self.keep = keep
+
+        self.thread = None
+        self.saves = max((self.save_number(path) for path in self.checkpoints()), default=0) + 1
+        self.replay_saved = 0 #id of the first episode not yet written
+
+        os.makedirs(self.replay_dir, exist_ok=True)
+
+    @staticmethod
+    def save_number(path):
+        parts = os.path.basename(path)[:-len(".chkpt")].split("-")
+        return int(parts[1]) if len(parts) == 3 else 0
+
+    def checkpoints(self):
+        # oldest first
+        paths = glob.glob(os.path.join(self.directory, "checkpoint-*.chkpt"))
+        return sorted(paths, key=lambda path: (self.save_number(path), os.path.basename(path)))
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def save(self, state, step, replay=None):
+        # state None only persists the replay
+        self.wait() #one write in flight at a time
+
+        state = snapshot(state)
+        episodes, first_id, pending = None, None, None
+        if replay is not None and not isinstance(replay, EpisodeStore):
+            episodes, first_id = replay.export_episodes(self.replay_saved)
+            self.replay_saved = replay.added
+        if replay is not None:
+            pending = replay.pending_episodes()
+
+        self.thread = threading.Thread(target=self.write, args=(state, step, replay, episodes, first_id, pending))
+        self.thread.start()
+
+    def write(self, state, step, replay, episodes, first_id, pending=None):
+        if state is not None and self.keep > 0:
+            path = os.path.join(self.directory, "checkpoint-%06d-%09d.chkpt" % (self.saves, step))
+            self.saves += 1
+            torch.save(state, path + ".tmp")
+            os.replace(path + ".tmp", path)
+
+            checkpoints = self.checkpoints()
+            for old in checkpoints[:len(checkpoints) - self.keep]:
+                os.remove(old)
+
+        if isinstance(replay, EpisodeStore):
+            replay.flush()
+        elif episodes is not None:
+            self.write_replay(episodes, first_id)
+        if pending is not None:
+            self.write_pending(pending)
+
+    def episode_path(self, episode_id):
+        return os.path.join(self.replay_dir, "episode-%09d.npz" % episode_id)
+
+    def write_replay(self, episodes, first_id):
+        for episode_id, episode in episodes:
+            path = self.episode_path(episode_id)
+            with open(path + ".tmp", "wb") as f:
+                np.savez(f, **episode)
+            os.replace(path + ".tmp", path)
+
+        for path in glob.glob(os.path.join(self.replay_dir, "episode-*.npz")): #evicted from the buffer
+            if int(os.path.basename(path)[8:17]) < first_id:
+                os.remove(path)
+
+    def write_pending(self, episodes):
+        # replaces the previous snapshot, new files first so a crash leaves at least one of them
+        old = glob.glob(os.path.join(self.replay_dir, "pending-*.npz"))
+        written = set()
+        for episode in episodes:
+            path = os.path.join(self.replay_dir, "pending-%s.npz" % episode["key"])
+            with open(path + ".tmp", "wb") as f:
+                np.savez(f, **{k: v for k, v in episode.items() if k != "key"})
+            os.replace(path + ".tmp", path)
+            written.add(path)
+        for path in old:
+            if path not in written:
+                os.remove(path)
+
+    def restore_pending(self, replay):
+        """
+        Adds the last snapshot of the episodes that were being collected to replay, as
+        episodes that end without done. For a ReplayBuffer the files stay until the
+        next save replaces them, so a second restart before that restores them again
+        instead of losing them. An EpisodeStore persists them itself, so the files are
+        deleted once it is flushed and a second restart does not store them twice.
+        """
+        paths = sorted(glob.glob(os.path.join(self.replay_dir, "pending-*.npz")))
+        for path in paths:
+            with np.load(path) as episode:
+                if len(episode["actions"]) > 0:
+                    replay.add_episode(
+                        episode["obs"], episode["actions"], episode["rewards"], episode["dones"],
+                        version=int(episode["version"])
+                    )
+        if isinstance(replay, EpisodeStore) and paths:
+            replay.flush()
+            for path in paths:
+                os.remove(path)
+
+    def restore_replay(self, replay):
+        """
+        Refills a ReplayBuffer with the persisted episodes, oldest first.
+        """
+        paths = sorted(glob.glob(os.path.join(self.replay_dir, "episode-*.npz")))
+        for path in paths:
+            with np.load(path) as episode:
+                obs = episode["obs"]
+                if obs.dtype.kind == "f" and replay.obs_dtype == np.uint8: # RAM bytes shifted by -255/2 by older versions
+                    obs = np.rint(obs + 255/2)
+                replay.add_episode(
+                    obs, episode["actions"], episode["rewards"], episode["dones"],
+                    version=int(episode["version"])
+                )
+        if paths: # the files already on disk are not written again
+            replay.renumber(int(os.path.basename(paths[-1])[8:17]) + 1)
+        self.replay_saved = replay.added
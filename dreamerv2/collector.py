@@ -0,0 +1,310 @@
+from math import tanh
+import signal
+import threading
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from .model import WorldModel, Actor
+
+# collector processes are spawned, forking after torch started its thread pools can deadlock the child
+spawn_context = mp.get_context("spawn")
+
+def make_env(env_name, pixels=False):
+    import gym
+    return gym.make(env_name, obs_type="rgb" if pixels else "ram", full_action_space=True)
+
+def env_worker(remote, parent_remote, env_fn):
+    # Ctrl-C reaches the whole process group, the learner shuts the workers down itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    parent_remote.close()
+    env = env_fn()
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == "step":
+                obs, rew, done, _ = env.step(data)
+                remote.send((obs, rew, done))
+            elif cmd == "reset":
+                remote.send(env.reset())
+            elif cmd == "close":
+                break
+    finally:
+        env.close()
+        remote.close()
+
+class SubprocVecEnv:
+    """
+    Steps N environments in worker processes. Environments are not reset
+    automatically so the terminal observation of every episode is kept.
+    Workers are spawned, not forked, for the same reason as the collector
+    processes, so env_fns must be picklable.
+    """
+    def __init__(self, env_fns):
+        self.num_envs = len(env_fns)
+        self.remotes, work_remotes = zip(*[spawn_context.Pipe() for _ in env_fns])
+        self.processes = [
+            spawn_context.Process(target=env_worker, args=(work_remote, remote, env_fn), daemon=True)
+            for work_remote, remote, env_fn in zip(work_remotes, self.remotes, env_fns)
+        ]
+        for process, work_remote in zip(self.processes, work_remotes):
+            process.start()
+            work_remote.close()
+
+    def reset(self, indices=None):
+        indices = range(self.num_envs) if indices is None else indices
+        for i in indices:
+            self.remotes[i].send(("reset", None))
+        return np.stack([self.remotes[i].recv() for i in indices])
+
+    def step(self, actions):
+        for remote, action in zip(self.remotes, actions):
+            remote.send(("step", int(action)))
+        obs, rews, dones = zip(*[remote.recv() for remote in self.remotes])
+        return np.stack(obs), np.array(rews, dtype=np.float32), np.array(dones)
+
+    def close(self, timeout=10):
+        for remote in self.remotes:
+            try:
+                remote.send(("close", None))
+            except (BrokenPipeError, EOFError): # worker already gone
+                pass
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+class VectorCollector:
+    """
+    Collects episodes from a SubprocVecEnv with one batched world model and
+    actor call per step and pushes finished episodes into the replay.
+    Observations are preprocessed a batch at a time and stored as uint8,
+    see Preprocessor.
+
+    start() runs the collector on a thread, pause() and resume() hold and continue
+    it between steps and stop() ends it. Every flush_interval steps a copy of the
+    episodes in progress goes to replay.set_pending, so a checkpoint can persist
+    them. On stop they are added to the replay as episodes that end without done.
+    In a collector process, running and stopped are multiprocessing Events set by
+    the learner.
+    """
+    def __init__(self, envs, world, actor, replay, preprocess, device, params=None,
+                 name="0", flush_interval=0, running=None, stopped=None):
+        self.envs = envs
+        self.world = world
+        self.actor = actor
+        self.replay = replay
+        self.preprocess = preprocess
+        self.device = device
+        self.params = params #SharedParameters to follow, uses world and actor as is if None
+        self.name = name #tells the pending episodes of several collectors apart
+        self.flush_interval = flush_interval #steps between snapshots of the episodes in progress, 0 for never
+
+        self.running = threading.Event() if running is None else running #cleared while paused
+        self.stopped = threading.Event() if stopped is None else stopped
+        self.thread = None
+
+        self.version = 0
+        self.episodes = 0
+        self.steps = 0
+
+    def start(self):
+        self.running.set()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def pause(self):
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    def stop(self, timeout=None):
+        self.stopped.set()
+        self.running.set() # wake up if paused
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def wait_running(self):
+        # blocks while paused, False once stopped
+        while not self.running.wait(0.1):
+            if self.stopped.is_set():
+                return False
+        return not self.stopped.is_set()
+
+    def in_progress(self, episodes, versions):
+        # copies of the episodes in progress with at least one transition
+        return [
+            {
+                "key": "%s-%d" % (self.name, i),
+                "obs": np.stack(obs_list),
+                "actions": np.array(action_list),
+                "rewards": np.array(reward_list, dtype=np.float32),
+                "dones": np.array(done_list),
+                "version": int(versions[i]),
+            }
+            for i, (obs_list, action_list, reward_list, done_list) in enumerate(episodes)
+            if action_list
+        ]
+
+    def run(self):
+        N = self.envs.num_envs
+        with torch.no_grad():
+            obs = self.preprocess(self.envs.reset())
+            episodes = [([o.copy()], [], [], []) for o in obs]
+            versions = np.zeros(N, dtype=np.int64) #policy version each episode was started with
+            versions[:] = self.version
+
+            a = torch.zeros((N, self.world.num_action), device=self.device)
+            z_sample = torch.zeros((N, 32*32), device=self.device)
+            h = torch.zeros((N, 512), device=self.device)
+            reset = torch.ones(N, dtype=torch.bool, device=self.device)
+
+            iteration = 0
+            while self.wait_running():
+                if self.params is not None:
+                    self.version = self.params.pull({"world": self.world, "actor": self.actor}, self.version)
+
+                x = self.preprocess.to_float(torch.from_numpy(obs).to(self.device))
+                z_sample, h = self.world.forward_inference(a, x, z_sample, h, reset=reset)
+                a = self.actor(z_sample)
+                a = torch.distributions.one_hot_categorical.OneHotCategorical(logits = a).sample()
+                z_sample = z_sample.reshape(N, 32*32)
+
+                actions = a.argmax(dim=-1).cpu().numpy()
+                obs, rews, dones = self.envs.step(actions)
+                obs = self.preprocess(obs)
+                self.steps += N
+
+                for i, (obs_list, action_list, reward_list, done_list) in enumerate(episodes):
+                    obs_list.append(obs[i].copy()) # rows must not keep the whole batch alive
+                    action_list.append(actions[i])
+                    reward_list.append(tanh(rews[i]))
+                    done_list.append(dones[i])
+
+                finished = np.flatnonzero(dones)
+                for i in finished:
+                    self.replay.add_episode(
+                        np.stack(episodes[i][0]),
+                        np.array(episodes[i][1]),
+                        np.array(episodes[i][2], dtype=np.float32),
+                        np.array(episodes[i][3]),
+                        version=int(versions[i])
+                    )
+                    self.episodes += 1
+
+                if len(finished):
+                    obs[finished] = self.preprocess(self.envs.reset(finished))
+                    for i in finished:
+                        episodes[i] = ([obs[i].copy()], [], [], [])
+                    versions[finished] = self.version
+
+                reset = torch.from_numpy(dones).to(self.device)
+
+                iteration += 1
+                if self.flush_interval and not iteration % self.flush_interval:
+                    self.replay.set_pending(self.name, self.in_progress(episodes, versions))
+
+            # stopped: keep what was collected so far as truncated episodes
+            for episode in self.in_progress(episodes, versions):
+                self.replay.add_episode(
+                    episode["obs"], episode["actions"], episode["rewards"], episode["dones"],
+                    version=episode["version"]
+                )
+                self.episodes += 1
+            self.replay.set_pending(self.name, [])
+
+class SharedParameters:
+    """
+    Versioned snapshot of module parameters in shared memory. The learner
+    publishes new versions and collector processes pick them up, both without
+    waiting for each other: whoever finds the snapshot busy simply retries on
+    its next call.
+    """
+    def __init__(self, modules, version=0):
+        self.tensors = {
+            name: {k: v.detach().cpu().clone().share_memory_() for k, v in module.state_dict().items()}
+            for name, module in modules.items()
+        }
+        self.version = spawn_context.Value("q", version, lock=False)
+        self.lock = spawn_context.Lock()
+
+    def publish(self, modules, version=None):
+        """
+        Copies modules into the snapshot, labelled version or the previous version + 1.
+        Returns False without waiting if a collector is reading it.
+        """
+        if not self.lock.acquire(block=False):
+            return False
+        try:
+            with torch.no_grad():
+                for name, module in modules.items():
+                    for k, v in module.state_dict().items():
+                        self.tensors[name][k].copy_(v)
+            self.version.value = self.version.value + 1 if version is None else version
+        finally:
+            self.lock.release()
+        return True
+
+    def pull(self, modules, version, block=False):
+        """
+        Loads the snapshot into modules if it is newer than version, returns the version now held.
+        """
+        if self.version.value == version or not self.lock.acquire(block=block):
+            return version
+        try:
+            for name, module in modules.items():
+                module.load_state_dict(self.tensors[name])
+            return self.version.value
+        finally:
+            self.lock.release()
+
+class EpisodeQueue:
+    """
+    Stand-in replay for collector processes, forwards finished episodes and
+    snapshots of the episodes in progress to the learner.
+    """
+    def __init__(self, queue):
+        self.queue = queue
+
+    def add_episode(self, *episode, version=0):
+        self.queue.put(("episode", episode, version))
+
+    def set_pending(self, name, episodes):
+        self.queue.put(("pending", name, episodes))
+
+def drain_episodes(queue, replay):
+    # until the learner puts None after the collector processes exited
+    while True:
+        item = queue.get()
+        if item is None:
+            return
+        kind, a, b = item
+        if kind == "episode":
+            replay.add_episode(*a, version=b)
+        else:
+            replay.set_pending(a, b)
+
+def collector_process(params, queue, env_fn, num_envs, gamma, num_actions, preprocess, num_threads=1,
+                      obs_shape=(128,), encoder="mlp", name="0", flush_interval=0, running=None, stopped=None):
+    """
+    Collector with its own WorldModel and Actor copies that follow params.
+    Ignores SIGINT, the learner stops it through stopped.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    torch.set_num_threads(num_threads)
+    world = WorldModel(gamma, num_actions, obs_shape=obs_shape, encoder=encoder)
+    actor = Actor(num_actions)
+
+    envs = SubprocVecEnv([env_fn for _ in range(num_envs)])
+    collector = VectorCollector(
+        envs, world, actor, EpisodeQueue(queue), preprocess, "cpu", params=params,
+        name=name, flush_interval=flush_interval, running=running, stopped=stopped
+    )
+    collector.version = params.pull({"world": world, "actor": actor}, -1, block=True)
+    try:
+        collector.run()
+    finally:
+        envs.close()
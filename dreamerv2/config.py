@@ -0,0 +1,102 @@
+import argparse
+from dataclasses import dataclass, fields
+from typing import Optional
+
+# allowed values of the string options, checked when a Config is created
+CHOICES = {
+    "precision": ("fp32", "bf16", "fp16"),
+    "memory_mode": ("full", "checkpoint", "tbptt"),
+    "obs_type": ("ram", "pixels"),
+    "encoder": ("mlp", "conv"),
+    "sampling": ("episodes", "uniform", "recency", "loss"),
+}
+
+@dataclass
+class Config:
+    ### ENVIRONMENT ###
+    env_name: str = "BreakoutNoFrameskip-v4"
+    obs_type: str = "ram" # "ram" (128 bytes) or "pixels" (frames, downsampled by the collectors)
+    frame_size: int = 64 # side of the downsampled frames
+    grayscale: bool = True # single-channel frames
+    num_envs: int = 4 # environments stepped in parallel by the collector
+    decoupled: bool = False # collectors run in their own processes with their own model copies
+    num_collectors: int = 2 # collector processes in decoupled mode, each stepping num_envs envs
+    publish_interval: int = 10 # iterations between parameter snapshots for the collectors
+
+    ### REPLAY ###
+    history_size: int = 64 # sequences per epoch
+    replay_capacity: int = 2**18 # steps kept in replay
+    replay_dir: Optional[str] = None # memory-mapped episode store on disk instead of RAM replay if set
+    replay_budget: int = 8*2**30 # bytes kept on disk by the episode store
+    sampling: str = "episodes" # sequence starts: "episodes" (uniform episode, then offset), "uniform" over steps, "recency" or "loss"
+    priority_alpha: float = 0.6 # sharpness of loss priorities
+    recency_half_life: float = 1e5 # env steps after which recency priorities halve
+    prefetch: int = 2 # batches prepared ahead on a background thread, 0 samples on the training thread
+
+    ### WORLD MODEL ###
+    batch: int = 64
+    L: int = 50 # seq len world training
+    encoder: str = "mlp" # observation encoder/decoder: "mlp" or "conv" (pixels with frame_size 64)
+    lr_world: float = 2e-4
+    memory_mode: str = "full" # world-model backprop: "full", "checkpoint" (recompute activations) or "tbptt"
+    tbptt_chunk: int = 10 # steps per truncated backprop chunk in tbptt mode
+
+    ### ACTOR CRITIC ###
+    H: int = 15 # imagination length
+    compile_imagination: bool = False # run the dream rollout through torch.compile
+    compact_latents: bool = False # dream with int16 latent indices and gather-sum input layers
+    gamma: float = 0.995 # discount factor
+    lamb: float = 0.95 # lambda-target
+    lr_actor: float = 4e-5
+    lr_critic: float = 1e-4
+    actor_reinforce: float = 0.9 # weight of the REINFORCE term of the actor loss
+    actor_dynamics: float = 0.1 # initial weight of the dynamics backprop term, annealed to 0
+    actor_entropy: float = 3e-3 # initial weight of the entropy bonus, annealed to 3e-4
+    target_interval: int = 100 # update interval for target critic
+    actor_critic_updates: int = 1 # actor-critic updates per world-model update, all but the first start from the latent cache
+    latent_cache: int = 0 # replay steps whose latest posterior is cached, 0 disables the cache (and extra updates)
+    latent_max_age: int = 50 # world-model updates after which a cached latent is stale and gets re-encoded
+    refresh_batch: int = 16 # stale latents re-encoded per background job, each with its window of L steps
+
+    ### OPTIMIZATION ###
+    gradient_clipping: float = 100
+    precision: str = "fp32" # "bf16" (CPU or GPU) or "fp16" (GPU, with loss scaling) autocast
+    adam_eps: float = 1e-5
+    decay: float = 1e-6
+
+    ### DISTRIBUTED ###
+    world_size: int = 1 # data-parallel training processes, each with its own collectors and replay
+    dist_addr: str = "127.0.0.1" # rendezvous of locally spawned processes
+    dist_port: int = 29500
+
+    ### CHECKPOINTS ###
+    save_dir: str = "checkpoints"
+    save_interval: float = 60 # seconds between checkpoints
+    keep_checkpoints: int = 3 # most recent checkpoints kept on disk, 0 writes none
+    persist_replay: bool = True # save new replay episodes with every checkpoint
+    flush_interval: int = 500 # collector steps between snapshots of the episodes in progress, saved with the checkpoints
+
+    ### METRICS ###
+    metrics_path: Optional[str] = None # .jsonl or .csv file metrics are appended to
+    log_interval: int = 10 # iterations per metrics record
+    sync_timing: bool = False # wait for the GPU at phase boundaries for exact phase times
+    profile_dir: Optional[str] = None # write a torch.profiler trace of a few iterations here
+    profile_wait: int = 10 # iterations before the traced ones
+    profile_steps: int = 5 # traced iterations
+
+    def __post_init__(self):
+        for name, choices in CHOICES.items():
+            if getattr(self, name) not in choices:
+                raise ValueError("%s must be one of %s, got %r" % (name, ", ".join(choices), getattr(self, name)))
+
+    @classmethod
+    def from_args(cls, argv=None):
+        parser = argparse.ArgumentParser(prog="dreamerv2", description="Train DreamerV2")
+        for field in fields(cls):
+            if field.type is bool:
+                parser.add_argument("--" + field.name, action=argparse.BooleanOptionalAction, default=field.default)
+            else:
+                field_type = str if field.type is Optional[str] else field.type
+                parser.add_argument("--" + field.name, type=field_type, default=field.default, choices=CHOICES.get(field.name))
+
+        return cls(**vars(parser.parse_args(argv)))
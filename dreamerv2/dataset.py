@@ -3,9 +3,32 @@ import torch
 import torch.nn as nn
 from torch.utils.data import Dataset
 
+def sample_windows(lengths, seq_len, batch_size=None, episodes=None):
+    """
+    Draws (episode, offset) pairs for windows of seq_len transitions.
+    Only episodes with at least seq_len transitions are eligible, so offsets never go negative.
+    In:
+        lengths:  [E] transitions per stored episode
+        episodes: optional indices into the eligible episodes, drawn uniformly otherwise
+    Out:
+        episodes: [B] episode indices
+        offsets:  [B] first transition of each window
+    """
+    eligible = np.flatnonzero(lengths >= seq_len)
+    if len(eligible) == 0:
+        raise ValueError("no episode with at least %d transitions in replay" % seq_len)
+
+    if episodes is None:
+        episodes = np.random.randint(0, len(eligible), size=batch_size)
+    episodes = eligible[np.asarray(episodes) % len(eligible)]
+
+    offsets = (np.random.random_sample(len(episodes)) * (lengths[episodes] - seq_len + 1)).astype(np.int64)
+
+    return episodes, offsets
+
 class ModelDataset(Dataset):
-    def __init__(self, history, seq_len, gamma, history_size):
-        self.h = history #history is passed as list and updated outside
+    def __init__(self, replay, seq_len, gamma, history_size):
+        self.replay = replay #replay buffer is filled outside
         self.seq_len = seq_len
         self.gamma = gamma
         self.history_size = history_size
@@ -14,20 +37,90 @@ class ModelDataset(Dataset):
         return self.history_size
 
     def __getitem__(self, idx):
-        idx = idx % len(self.h) #do not exceed history length
-        episode = self.h[idx]
+        with self.replay.lock:
+            episodes, offsets = sample_windows(self.replay.episode_lengths(), self.seq_len, episodes=[idx])
+            obs, actions, rewards, dones = self.replay.gather(episodes, offsets, self.seq_len)
+
+        states = torch.from_numpy(obs[0])
+        actions = nn.functional.one_hot(torch.from_numpy(actions[0]), self.replay.num_actions).float()
+        rewards = torch.from_numpy(rewards[0])
+        gammas = (~torch.from_numpy(dones[0])).float()*self.gamma #gamma if not done else 0
+
+        return states, actions, rewards.unsqueeze(1), gammas.unsqueeze(1)
+
+class SequenceSampler:
+    """
+    Samples whole [B, L, ...] batches from a replay buffer in one go.
+    The returned tensors are reused (and pinned if requested) across calls, so they
+    are only valid until the next call to sample. sample_into fills other buffer sets
+    from allocate, e.g. to prepare several batches ahead.
+    """
+    def __init__(self, replay, batch_size, seq_len, gamma, pin_memory=False):
+        self.replay = replay
+        self.batch_size = batch_size
+        self.seq_len = seq_len
+        self.gamma = gamma
+        self.pin_memory = pin_memory
+
+        self.buffers = self.allocate()
+        self.info = None #info of the last batch of sample
+        self.versions = None #policy version of each sequence of the last batch
+
+    def allocate(self):
+        # one set of output tensors and the staging arrays of the fields transformed before output
+        B, L, replay = self.batch_size, self.seq_len, self.replay
+        states = torch.from_numpy(np.empty((B, L+1, *replay.obs_shape), dtype=replay.obs_dtype)) # as stored, e.g. uint8
+        return {
+            "states": states.pin_memory() if self.pin_memory else states,
+            "actions": torch.empty((B, L, replay.num_actions), dtype=torch.float32, pin_memory=self.pin_memory),
+            "rewards": torch.empty((B, L, 1), dtype=torch.float32, pin_memory=self.pin_memory),
+            "gammas": torch.empty((B, L, 1), dtype=torch.float32, pin_memory=self.pin_memory),
+            "action_idx": np.empty((B, L), dtype=np.int64),
+            "dones": np.empty((B, L), dtype=np.bool_),
+        }
+
+    def ready(self):
+        return bool((self.replay.episode_lengths() >= self.seq_len).any())
+
+    def wait_ready(self, timeout=None):
+        return self.replay.wait_for(self.ready, timeout)
+
+    def draw(self):
+        # episodes uniformly, then a window of each, called with the replay locked
+        episodes, offsets = sample_windows(self.replay.episode_lengths(), self.seq_len, self.batch_size)
+        return episodes, offsets, {}
 
-        idx_sample = np.random.randint(0, (len(episode)-1)//4) #sample random part of episode
-        idx_sample = min(idx_sample, (len(episode)-1)//4-self.seq_len) #clip to not exceed limit
+    def sample_into(self, buffers):
+        """
+        Fills a buffer set from allocate with a new batch.
+        Out:
+            batch: (states, actions, rewards, gammas) tensors of buffers, as returned by sample
+            info:  dict with the policy version of each sequence under "versions", the
+                   step id of its first observation under "steps" and whatever else
+                   draw recorded about the batch
+        """
+        with self.replay.lock:
+            episodes, offsets, info = self.draw()
+            self.replay.gather(
+                episodes, offsets, self.seq_len,
+                out=(buffers["states"].numpy(), buffers["action_idx"], buffers["rewards"].numpy()[..., 0], buffers["dones"])
+            )
+            info["versions"] = self.replay.episode_versions()[episodes]
+            info["steps"] = self.replay.episode_first_steps()[episodes] + offsets
 
-        states = episode[idx_sample*4 : (idx_sample+1)*4+self.seq_len*4 : 4]
-        actions= episode[idx_sample*4+1 : idx_sample*4+self.seq_len*4+1 : 4]
-        rewards= episode[idx_sample*4+2 : idx_sample*4+self.seq_len*4+2 : 4]
-        gammas = episode[idx_sample*4+3 : idx_sample*4+self.seq_len*4+3 : 4]
+        buffers["actions"].zero_().scatter_(2, torch.from_numpy(buffers["action_idx"]).unsqueeze(2), 1)
+        np.multiply(~buffers["dones"], self.gamma, out=buffers["gammas"].numpy()[..., 0])
 
-        states = torch.cat(states, dim=0)
-        actions = torch.cat(actions, dim=0)
-        rewards = torch.Tensor(rewards)
-        gammas = (-torch.Tensor(gammas) + 1)*self.gamma #gamma if not done else 0 but with tensors
+        return (buffers["states"], buffers["actions"], buffers["rewards"], buffers["gammas"]), info
 
-        return states, actions, rewards.unsqueeze(1), gammas.unsqueeze(1)
\ No newline at end of file
+    def sample(self):
+        """
+        Out:
+            states:  [B, L+1, *obs_shape] in the dtype of the replay
+            actions: [B, L, num_actions] one-hot
+            rewards: [B, L, 1]
+            gammas:  [B, L, 1] gamma if not done else 0
+        """
+        batch, self.info = self.sample_into(self.buffers)
+        self.versions = self.info["versions"]
+        return batch
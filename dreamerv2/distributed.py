@@ -0,0 +1,69 @@
+import os
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+def all_reduce_gradients(parameters):
+    """
+    Averages the gradients of parameters over all ranks with one all-reduce.
+    Missing gradients count as zero so every rank sends the same buffer.
+    """
+    parameters = list(parameters)
+    for p in parameters:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+
+    flat = torch.cat([p.grad.reshape(-1) for p in parameters])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+
+    offset = 0
+    for p in parameters:
+        n = p.numel()
+        p.grad.copy_(flat[offset:offset+n].view_as(p.grad))
+        offset += n
+
+def broadcast_modules(modules, src=0):
+    # parameters and buffers of src replace those of every other rank
+    with torch.no_grad():
+        for module in modules:
+            for tensor in list(module.parameters()) + list(module.buffers()):
+                dist.broadcast(tensor.data, src)
+
+def broadcast_int(value, src=0):
+    tensor = torch.tensor([value], dtype=torch.int64)
+    dist.broadcast(tensor, src)
+    return int(tensor.item())
+
+def worker(rank, config, world_size):
+    # one training process of a local group started by launch
+    from .train import Trainer
+
+    os.environ.setdefault("MASTER_ADDR", config.dist_addr)
+    os.environ.setdefault("MASTER_PORT", str(config.dist_port))
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    try:
+        Trainer(config, rank=rank, world_size=world_size).run()
+    finally:
+        dist.destroy_process_group()
+
+def launch(config):
+    """
+    Trains with config.world_size processes. Under torchrun (RANK and WORLD_SIZE set)
+    this process is one rank of the group, otherwise the ranks are spawned locally.
+    """
+    from .train import Trainer
+
+    if "RANK" in os.environ and "WORLD_SIZE" in os.environ:
+        rank, world_size = int(os.environ["RANK"]), int(os.environ["WORLD_SIZE"])
+        dist.init_process_group("gloo")
+        try:
+            Trainer(config, rank=rank, world_size=world_size).run()
+        finally:
+            dist.destroy_process_group()
+    elif config.world_size > 1:
+        mp.spawn(worker, args=(config, config.world_size), nprocs=config.world_size)
+    else:
+        Trainer(config).run()
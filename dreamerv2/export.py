@@ -0,0 +1,164 @@
+"""
+Standalone policy artifacts for deployment.
+
+    python -m dreamerv2.export checkpoints/checkpoint-000004-000001000.chkpt policy.pt --quantize
+"""
+import argparse
+import copy
+
+import torch
+import torch.nn as nn
+
+from .model import WorldModel, Actor, sample_one_hot
+
+class Policy(nn.Module):
+    """
+    The inference path of a WorldModel and Actor: encoder, GRU, posterior and actor,
+    with the recurrent state as explicit inputs and outputs. The modules are copied
+    and set to eval, so dropout is off and the originals can keep training.
+
+    In:
+        obs:    [N, *obs_shape] observations as stored in the replay, i.e. RAM bytes
+                or frames from Preprocessor, any dtype
+        a:      [N, num_actions] one-hot previous actions
+        z:      [N, 1024] previous posterior samples
+        h:      [N, 512] previous GRU states
+        reset:  [N] True for the first step of an episode
+        sample: sample z and the action, argmax of both otherwise
+    Out:
+        action: [N] action indices
+        a:      [N, num_actions] one-hot actions, next input a
+        logits: [N, num_actions] actor logits
+        z, h:   next input z and h
+    """
+    def __init__(self, world, actor):
+        super(Policy, self).__init__()
+        self.num_actions = world.num_action
+        self.pixels = len(world.obs_shape) == 3 # scaled like Preprocessor.to_float
+        self.flatten = world.encoder == "mlp"
+
+        self.encoder = copy.deepcopy(world.representation_model_encoder)
+        self.gru = copy.deepcopy(world.gru)
+        self.posterior = copy.deepcopy(world.representation_model_mlp)
+        self.actor = copy.deepcopy(actor.model)
+        for module in self.children():
+            module.eval()
+            module.requires_grad_(False)
+
+    def forward(self, obs, a, z, h, reset, sample: bool = True):
+        x = obs.float() / 255 - 0.5 if self.pixels else obs.float() - 255/2
+        if self.flatten:
+            x = x.reshape(x.shape[0], -1)
+        h = self.gru(torch.cat((z, a), dim=1), h)
+        h = h.masked_fill(reset.unsqueeze(1), 0.0)
+
+        embedding = self.encoder(x).reshape(-1, 512)
+        z_logits = self.posterior(torch.cat((h, embedding), dim=1)).reshape(-1, 32, 32)
+        if sample:
+            z = sample_one_hot(z_logits)
+        else:
+            z = torch.zeros_like(z_logits).scatter_(-1, z_logits.argmax(dim=-1, keepdim=True), 1.0)
+        z = z.reshape(-1, 32*32)
+
+        logits = self.actor(z)*2
+        if sample:
+            a = sample_one_hot(logits)
+        else:
+            a = torch.zeros_like(logits).scatter_(-1, logits.argmax(dim=-1, keepdim=True), 1.0)
+
+        return a.argmax(dim=-1), a, logits, z, h
+
+def initial_state(policy, batch_size, device="cpu"):
+    """
+    Out:
+        a, z, h, reset: inputs of the first step of batch_size new episodes
+    """
+    return (
+        torch.zeros((batch_size, policy.num_actions), device=device),
+        torch.zeros((batch_size, 32*32), device=device),
+        torch.zeros((batch_size, 512), device=device),
+        torch.ones(batch_size, dtype=torch.bool, device=device),
+    )
+
+def quantize(policy):
+    # int8 weights for the Linear and GRUCell layers, activations are quantized on the fly
+    return torch.ao.quantization.quantize_dynamic(policy, {nn.Linear, nn.GRUCell}, dtype=torch.qint8)
+
+def export(world, actor, path=None, quantized=False):
+    """
+    Scripts the policy of world and actor, optionally int8, and saves it to path if given.
+    The artifact only needs torch.jit.load to run.
+    """
+    policy = Policy(world, actor)
+    if quantized:
+        policy = quantize(policy)
+    scripted = torch.jit.script(policy)
+    if path is not None:
+        torch.jit.save(scripted, path)
+    return scripted
+
+def check_parity(reference, policy, obs):
+    """
+    Runs both policies over the same observation sequence without sampling, feeding
+    both the recurrent state of the reference so errors do not compound.
+    In:
+        reference: fp32 Policy
+        policy:    policy to check, e.g. scripted or quantized
+        obs:       [T, N, *obs_shape] observations
+    Out:
+        report: max abs error of h and of the logits, fraction of equal actions and of equal z
+    """
+    a, z, h, reset = initial_state(reference, obs.shape[1])
+    errors_h, errors_logits, same_actions, same_z = [], [], [], []
+    with torch.inference_mode():
+        for x in obs:
+            action, a_next, logits, z_next, h_next = reference(x, a, z, h, reset, sample=False)
+            action_p, _, logits_p, z_p, h_p = policy(x, a, z, h, reset, sample=False)
+
+            errors_h.append((h_next - h_p).abs().max())
+            errors_logits.append((logits - logits_p).abs().max())
+            same_actions.append((action == action_p).float().mean())
+            same_z.append((z_next == z_p).all(dim=1).float().mean())
+
+            a, z, h = a_next, z_next, h_next
+            reset = torch.zeros_like(reset)
+
+    return {
+        "max_error_h": float(torch.stack(errors_h).max()),
+        "max_error_logits": float(torch.stack(errors_logits).max()),
+        "action_agreement": float(torch.stack(same_actions).mean()),
+        "z_agreement": float(torch.stack(same_z).mean()),
+    }
+
+def load_checkpoint(path):
+    w = torch.load(path, map_location="cpu")
+    num_actions = w["actor"]["model.4.bias"].shape[0]
+    world = WorldModel(0.0, num_actions, **w.get("world_config", {})) # gamma is not used by the policy
+    actor = Actor(num_actions)
+    # the decoder is not part of the policy, older checkpoints have one of another shape
+    keys = world.load_state_dict(
+        {k: v for k, v in w["world"].items() if not k.startswith("state_predictor_decoder.")}, strict=False
+    )
+    mismatched = [k for k in keys.missing_keys + keys.unexpected_keys if not k.startswith("state_predictor_decoder.")]
+    if mismatched:
+        raise ValueError("%s does not match the world model: %s" % (path, ", ".join(mismatched)))
+    actor.load_state_dict(w["actor"])
+    return world, actor
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="dreamerv2.export", description="Export the policy of a checkpoint to TorchScript")
+    parser.add_argument("checkpoint")
+    parser.add_argument("out")
+    parser.add_argument("--quantize", action="store_true", help="int8 dynamic quantization of Linear and GRUCell layers")
+    parser.add_argument("--steps", type=int, default=100, help="steps of the parity check on random observations")
+    args = parser.parse_args(argv)
+
+    world, actor = load_checkpoint(args.checkpoint)
+    scripted = export(world, actor, args.out, quantized=args.quantize)
+
+    obs = torch.randint(0, 256, (args.steps, 16, *world.obs_shape), dtype=torch.uint8)
+    for name, value in check_parity(Policy(world, actor), scripted, obs).items():
+        print ("%s: %.6g" % (name, value))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import copy
+import threading
+
+import numpy as np
+import torch
+
+from .model import compress_latent, expand_latent
+
+class LatentCache:
+    """
+    Latest posterior (z, h) of replay steps, tagged with the world-model version
+    that computed it, to start extra actor-critic updates from without another
+    world-model pass.
+
+    Rows are direct-mapped by replay step id: step k lives in row k % capacity, so
+    the newest `capacity` steps never collide and older ones are simply overwritten.
+    z is kept as int16 category indices and h as float16 (h is a GRU state in
+    [-1, 1]), 1088 bytes per row.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.z = torch.zeros((capacity, 32), dtype=torch.int16)
+        self.h = torch.zeros((capacity, 512), dtype=torch.float16)
+        self.steps = np.full(capacity, -1, dtype=np.int64) #step id held by each row, -1 if empty
+        self.versions = np.zeros(capacity, dtype=np.int64)
+        self.lock = threading.Lock()
+
+    def write(self, steps, z, h, version):
+        """
+        In:
+            steps: [N] replay step ids
+            z:     [N, 32, 32] or [N, 1024] one-hot posteriors
+            h:     [N, 512]
+        """
+        steps = np.asarray(steps, dtype=np.int64).reshape(-1)
+        rows = steps % self.capacity
+        index = torch.from_numpy(rows)
+        z = compress_latent(z.reshape(len(rows), 32*32)).cpu()
+        h = h.detach().reshape(len(rows), 512).to("cpu", torch.float16)
+        with self.lock:
+            self.z[index] = z
+            self.h[index] = h
+            self.steps[rows] = steps
+            self.versions[rows] = version
+
+    def rows(self, min_step, version=None, max_age=None, fresh=True):
+        # rows of steps still in replay (id >= min_step), optionally only the fresh or only the stale ones
+        mask = self.steps >= min_step
+        if max_age is not None:
+            mask &= (self.versions >= version - max_age) == fresh
+        return np.flatnonzero(mask)
+
+    def sample(self, batch_size, min_step, version, max_age, device="cpu"):
+        """
+        Start states drawn uniformly, with replacement, from the fresh rows.
+        Out:
+            z: [batch_size, 32, 32] one-hot
+            h: [batch_size, 512] float32
+        """
+        with self.lock:
+            rows = self.rows(min_step, version, max_age)
+            if len(rows) == 0:
+                raise ValueError("no latent younger than %d updates in the cache" % max_age)
+            index = torch.from_numpy(rows[np.random.randint(0, len(rows), size=batch_size)])
+            z, h = self.z[index], self.h[index]
+
+        z = expand_latent(z.to(device)).reshape(batch_size, 32, 32)
+        return z, h.to(device).float()
+
+    def stale(self, batch_size, min_step, version, max_age):
+        # step ids of up to batch_size stale rows, oldest version first
+        with self.lock:
+            rows = self.rows(min_step, version, max_age, fresh=False)
+            rows = rows[np.argsort(self.versions[rows], kind="stable")[:batch_size]]
+            return self.steps[rows]
+
+    def stats(self, min_step, version, max_age):
+        with self.lock:
+            rows = self.rows(min_step)
+            ages = version - self.versions[rows]
+        return {
+            "latent_rows": len(rows),
+            "latent_fresh": float((ages <= max_age).mean()) if len(rows) else 0.0,
+            "latent_age_mean": float(ages.mean()) if len(rows) else 0.0,
+        }
+
+class LatentRefresher:
+    """
+    Background thread that re-encodes stale cache rows in batches. Each job takes
+    the stalest rows, runs the world model without gradients over a window of
+    seq_len steps of replay ending at each of them, from a zero state like the
+    training pass, and writes back the latents of the whole windows.
+
+    It runs a copy of the world model that follows the learner: whenever version
+    changed the copy loads the learner's weights while holding lock, which the
+    learner holds around its optimizer steps.
+    """
+    def __init__(self, cache, replay, world, preprocess, seq_len, batch_size, max_age, lock, device="cpu"):
+        self.cache = cache
+        self.replay = replay
+        self.learner = world
+        self.world = copy.deepcopy(world)
+        self.world.requires_grad_(False)
+        self.preprocess = preprocess
+        self.seq_len = seq_len
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.lock = lock
+        self.device = device
+
+        self.version = 0 #learner version, set by the learner
+        self.synced = None #version of the copy
+        self.refreshed = 0 #rows rewritten so far
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopped.is_set():
+            if not self.refresh():
+                self.stopped.wait(0.1) # nothing stale, check again later
+
+    def window(self, steps):
+        """
+        Windows of seq_len transitions that contain the given step ids, as late as
+        possible up to ending at them. Steps of episodes shorter than seq_len are skipped.
+        Called with the replay locked.
+        """
+        first_steps = self.replay.episode_first_steps()
+        episodes = np.searchsorted(first_steps, steps, side="right") - 1
+        lengths = self.replay.episode_lengths()[episodes]
+        keep = (episodes >= 0) & (lengths >= self.seq_len)
+        episodes = episodes[keep]
+        offsets = np.clip(steps[keep] - first_steps[episodes] - self.seq_len, 0, lengths[keep] - self.seq_len)
+        return episodes, offsets, first_steps[episodes] + offsets
+
+    def refresh(self):
+        """
+        One job. Returns False if there was nothing to refresh.
+        """
+        version = self.version
+        with self.replay.lock:
+            if self.replay.num_episodes == 0:
+                return False
+            min_step = int(self.replay.episode_first_steps()[0])
+            steps = self.cache.stale(self.batch_size, min_step, version, self.max_age)
+            if len(steps) == 0:
+                return False
+            episodes, offsets, starts = self.window(np.unique(steps))
+            if len(episodes) == 0:
+                return False
+            obs, actions, _, _ = self.replay.gather(episodes, offsets, self.seq_len)
+
+        if self.synced != version:
+            with self.lock:
+                self.world.load_state_dict(self.learner.state_dict())
+            self.synced = version
+
+        with torch.no_grad():
+            x = self.preprocess.to_float(torch.from_numpy(obs).to(self.device))
+            a = torch.nn.functional.one_hot(torch.from_numpy(actions).to(self.device), self.world.num_action).float()
+            _, z_sample, _, _, _, _, h = self.world.observe(x, a)
+
+        window_steps = starts[:, None] + np.arange(self.seq_len + 1)
+        self.cache.write(window_steps, z_sample, h, self.synced)
+        self.refreshed += window_steps.size
+        return True
@@ -0,0 +1,164 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import csv
+import json
+import os
+from time import perf_counter, time
+
+import torch
+
+class JsonlSink:
+    """
+    Appends one JSON object per record.
+    """
+    def __init__(self, path):
+        self.file = open(path, "a")
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class CsvSink:
+    """
+    Appends one row per record. The columns are fixed by the first record,
+    keys that show up later are dropped.
+    """
+    def __init__(self, path):
+        self.new_file = not os.path.isfile(path) or os.path.getsize(path) == 0
+        self.file = open(path, "a", newline="")
+        self.writer = None
+
+    def write(self, record):
+        if self.writer is None:
+            self.writer = csv.DictWriter(self.file, fieldnames=list(record), extrasaction="ignore")
+            if self.new_file:
+                self.writer.writeheader()
+        self.writer.writerow(record)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def make_sink(path):
+    # format is picked by extension, everything but .csv is written as JSONL
+    if path is None:
+        return None
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return CsvSink(path) if path.endswith(".csv") else JsonlSink(path)
+
+class Metrics:
+    """
+    Accumulates the wall time spent in each phase of an iteration and turns it,
+    together with running counters, into one record per call to record().
+
+    Phase times are reported in ms per iteration, counters as rates per second,
+    both averaged over the iterations since the previous record. With synchronize
+    pending CUDA work is waited for at both ends of a phase, which makes GPU phases
+    accurate at the cost of some throughput.
+    """
+    def __init__(self, sink=None, synchronize=False):
+        self.sink = sink
+        self.synchronize = synchronize and torch.cuda.is_available()
+
+        self.phases = defaultdict(float) #seconds spent per phase since the last record
+        self.counters = {} #counter values at the last record
+        self.last_step = None
+        self.last_time = perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize()
+            self.phases[name] += perf_counter() - start
+
+    def start(self, step, counters=None):
+        # sets the reference point of the first record without writing one
+        self.phases.clear()
+        self.counters = dict(counters or {})
+        self.last_step = step
+        self.last_time = perf_counter()
+
+    def record(self, step, counters=None, **values):
+        """
+        In:
+            step:     number of iterations done so far
+            counters: running totals, reported as <name>_per_sec
+            values:   reported as is
+        Out:
+            record: dict that was written to the sink
+        """
+        now = perf_counter()
+        elapsed = max(now - self.last_time, 1e-9)
+        iterations = max(step - self.last_step, 1) if self.last_step is not None else 1
+
+        record = {"step": step, "time": time()}
+        for name, seconds in self.phases.items():
+            record["time_%s_ms" % name] = 1000 * seconds / iterations
+        if self.last_step is not None:
+            record["updates_per_sec"] = (step - self.last_step) / elapsed
+        for name, total in (counters or {}).items():
+            if name in self.counters:
+                record["%s_per_sec" % name] = (total - self.counters[name]) / elapsed
+            self.counters[name] = total
+        record.update(values)
+
+        if self.sink is not None:
+            self.sink.write(record)
+
+        self.phases.clear()
+        self.last_step = step
+        self.last_time = now
+        return record
+
+    def close(self):
+        if self.sink is not None:
+            self.sink.close()
+
+class ProfilerWindow:
+    """
+    Traces `active` iterations with torch.profiler after skipping `wait` and warming
+    up for one, then writes a Chrome trace to directory and stops profiling.
+    step() is called once per iteration.
+    """
+    def __init__(self, directory, wait=10, active=5):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.remaining = wait + 1 + active
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=wait, warmup=1, active=active, repeat=1),
+            on_trace_ready=self.save,
+            record_shapes=True,
+        )
+        self.profiler.start()
+        self.running = True
+
+    def save(self, profiler):
+        profiler.export_chrome_trace(os.path.join(self.directory, "trace-%d.json" % os.getpid()))
+
+    def step(self):
+        if self.running:
+            self.profiler.step()
+            self.remaining -= 1
+            if not self.remaining:
+                self.stop()
+
+    def stop(self):
+        if self.running:
+            self.profiler.stop()
+            self.running = False
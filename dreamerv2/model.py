@@ -1,37 +1,160 @@
+from functools import partial
+import math
+
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
+
+def autocast(device, precision="fp32"):
+    """
+    Autocast context for precision in ("fp32", "bf16", "fp16"). Weights stay in fp32,
+    only the matmuls run in reduced precision.
+    """
+    if precision not in ("fp32", "bf16", "fp16"):
+        raise ValueError("unknown precision %r" % precision)
+    dtype = {"bf16": torch.bfloat16, "fp16": torch.float16}.get(precision)
+    return torch.autocast(device_type=device, dtype=dtype or torch.bfloat16, enabled=dtype is not None)
+
+def sample_one_hot(logits):
+    """
+    Gumbel-max sample of a one-hot categorical over the last dim, cheaper than torch.distributions.
+    """
+    logits = logits.detach().float()
+    gumbel = -torch.log(-torch.log(torch.rand_like(logits)))
+    index = (logits + gumbel).argmax(dim=-1, keepdim=True)
+    return torch.zeros_like(logits).scatter_(-1, index, 1.0)
+
+def sample_straight_through(logits):
+    """
+    One-hot sample with the straight-through gradient of the softmax, computed in fp32.
+    """
+    probs = torch.softmax(logits.float(), dim=-1)
+    return sample_one_hot(logits) + probs - probs.detach()
+
+def compress_latent(z):
+    """
+    Category indices of one-hot latents [..., 32, 32] or [..., 1024] as int16 [..., 32].
+    """
+    if z.shape[-1] == 32*32:
+        z = z.reshape(*z.shape[:-1], 32, 32)
+    return z.detach().argmax(dim=-1).to(torch.int16)
+
+def expand_latent(index):
+    # dense one-hot [..., 1024] of int16 category indices [..., 32]
+    one_hot = torch.zeros((*index.shape, 32), device=index.device)
+    return one_hot.scatter_(-1, index.long().unsqueeze(-1), 1.0).reshape(*index.shape[:-1], 32*32)
+
+class StraightThroughLatent(torch.autograd.Function):
+    """
+    Passes out through unchanged and gives probs, the softmax a one-hot latent z was
+    sampled from, the gradient of z @ weight, as z = one_hot + probs - probs.detach() would.
+    """
+    @staticmethod
+    def forward(ctx, out, probs, weight_t):
+        ctx.save_for_backward(weight_t)
+        return out.view_as(out)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        weight_t, = ctx.saved_tensors
+        return grad_out, (grad_out @ weight_t.t().to(grad_out.dtype)).reshape(-1, 32, 32), None
+
+def latent_weight(layer):
+    """
+    Latent columns of a Linear whose last 1024 inputs are a latent z, transposed to [1024, out]
+    rows for latent_matmul. Computing them once per rollout saves a copy per step.
+    """
+    weight = layer.weight[:, layer.weight.shape[1] - 32*32:]
+    if torch.is_autocast_enabled(weight.device.type):
+        weight = weight.to(torch.get_autocast_dtype(weight.device.type))
+    return weight.t().contiguous() # strided weights take a slow path in embedding_bag
+
+def latent_matmul(index, probs, weight_t):
+    """
+    z @ weight_t for one-hot latents z given by int16 category indices [N, 32]: a sum of
+    32 gathered rows instead of a 1024-wide matmul. probs [N, 32, 32] receives the
+    straight-through gradient of z if it requires grad.
+    """
+    flat = index.long() + torch.arange(0, 32*32, 32, device=index.device) # row of each category
+    out = nn.functional.embedding_bag(flat, weight_t, mode="sum")
+    if probs is not None and probs.requires_grad:
+        out = StraightThroughLatent.apply(out, probs, weight_t)
+    return out
+
+def latent_linear(layer, index, probs=None, x=None, weight_t=None):
+    """
+    layer(cat((x, z), dim=1)) for a Linear whose last 1024 inputs are the latent z,
+    given as int16 indices [N, 32] and optionally the probs [N, 32, 32] it was sampled from.
+    """
+    out = latent_matmul(index, probs, latent_weight(layer) if weight_t is None else weight_t)
+    if x is not None:
+        out = out + x.to(out.dtype) @ layer.weight[:, :layer.weight.shape[1] - 32*32].t().to(out.dtype)
+    if layer.bias is not None:
+        out = out + layer.bias.to(out.dtype)
+    return out
+
+def lambda_returns(rewards, discounts, values, bootstrap, lamb):
+    """
+    V_t = r_t + g_t*((1-lamb)*v_t+1 + lamb*V_t+1), computed with a reverse scan from V_H = bootstrap.
+    In:
+        rewards, discounts: [H, N, 1]
+        values:             [H, N, 1] values of the states following each step
+        bootstrap:          [N, 1]
+    Out:
+        returns: [H, N, 1]
+    """
+    inputs = rewards + discounts * (1-lamb) * values
+    decay = discounts * lamb
+
+    returns = torch.empty_like(inputs)
+    V = bootstrap
+    for t in range(rewards.shape[0]-1, -1, -1):
+        V = inputs[t] + decay[t] * V
+        returns[t] = V
+
+    return returns
 
 class WorldModel(nn.Module):
-    def __init__(self, gamma, num_action=18):
+    """
+    encoder: "mlp" flattens the observations, "conv" expects [C, 64, 64] frames
+    """
+    def __init__(self, gamma, num_action=18, obs_shape=(128,), encoder="mlp"):
         super(WorldModel, self).__init__()
         self.gamma = gamma #discount factor
         self.num_action = num_action
+        self.obs_shape = tuple(obs_shape)
+        self.encoder = encoder
+        obs_size = math.prod(self.obs_shape)
 
         #Recurrent Model (RSSM): ((z, a), h) -> h
         self.gru = nn.GRUCell(input_size=1024 + num_action, hidden_size=512)
 
-        # #q (1st part): (x) -> xembedded
-        # self.representation_model_encoder = nn.Sequential(
-        #     # 1,64,64
-        #     nn.Conv2d(3, 32, 3, padding=1, stride=2), # 32,32,32
-        #     nn.ELU(inplace=True),
-        #     nn.Conv2d(32, 64, 3, padding=1, stride=2), # 64,16,16
-        #     nn.ELU(inplace=True),
-        #     nn.Conv2d(64, 128, 3, padding=1, stride=2), # 128, 8, 8
-        #     nn.ELU(inplace=True),
-        #     nn.Conv2d(128, 256, 3, padding=1, stride=2), # 256, 4, 4
-        #     nn.ELU(inplace=True),
-        #     nn.Conv2d(256, 512, 4), # 512, 1, 1
-        #     nn.ELU(inplace=True)
-        # )
-        
-        self.representation_model_encoder = nn.Sequential(
-            nn.Linear(128, 256),
-            nn.ELU(inplace=True),
-            nn.Linear(256, 512),
-            nn.Dropout(0.5),
-        )
-        
+        #q (1st part): (x) -> xembedded
+        if encoder == "conv":
+            assert self.obs_shape[1:] == (64, 64), "conv encoder needs [C, 64, 64] observations"
+            self.representation_model_encoder = nn.Sequential(
+                # C,64,64
+                nn.Conv2d(self.obs_shape[0], 32, 3, padding=1, stride=2), # 32,32,32
+                nn.ELU(inplace=True),
+                nn.Conv2d(32, 64, 3, padding=1, stride=2), # 64,16,16
+                nn.ELU(inplace=True),
+                nn.Conv2d(64, 128, 3, padding=1, stride=2), # 128, 8, 8
+                nn.ELU(inplace=True),
+                nn.Conv2d(128, 256, 3, padding=1, stride=2), # 256, 4, 4
+                nn.ELU(inplace=True),
+                nn.Conv2d(256, 512, 4), # 512, 1, 1
+                nn.ELU(inplace=True)
+            )
+        elif encoder == "mlp":
+            self.representation_model_encoder = nn.Sequential(
+                nn.Linear(obs_size, 256),
+                nn.ELU(inplace=True),
+                nn.Linear(256, 512),
+                nn.Dropout(0.5),
+            )
+        else:
+            raise ValueError("unknown encoder %r" % encoder)
+
         #q (2nd part): (h, xembedded) -> z
         self.representation_model_mlp = nn.Sequential(
             nn.Linear(512+512, 1024),
@@ -71,29 +194,33 @@ class WorldModel(nn.Module):
             nn.ELU(inplace=True),
         )
         
-        # self.state_predictor_decoder = nn.Sequential( # 64, 4, 4
-        #     nn.ConvTranspose2d(64, 32, 3, stride=2, padding=1, output_padding=1), # 32, 8, 8
-        #     nn.ELU(inplace=True),
-        #     nn.ConvTranspose2d(32, 16, 3, stride=2, padding=1, output_padding=1), # 16, 16, 16
-        #     nn.ELU(inplace=True),
-        #     nn.ConvTranspose2d(16, 8, 3, stride=2, padding=1, output_padding=1), # 8, 32, 32
-        #     nn.ELU(inplace=True),
-        #     nn.ConvTranspose2d(8, 8, 3, stride=2, padding=1, output_padding=1), # 3, 64, 64
-        #     nn.ELU(inplace=True),
-        #     nn.Conv2d(8, 3, 3, padding=1),
-        # )
-        
-        self.state_predictor_decoder = nn.Sequential(
-            nn.Linear(1024, 512),
-            nn.ELU(inplace=True),
-            nn.Linear(512, 16),
-            nn.ELU(inplace=True),
-            nn.Linear(16, 8),
-            nn.ELU(inplace=True),
-            nn.Linear(8, 8),
-            nn.ELU(inplace=True)
-        )
-    
+        if encoder == "conv":
+            self.state_predictor_decoder = nn.Sequential( # 64, 4, 4
+                nn.ConvTranspose2d(64, 32, 3, stride=2, padding=1, output_padding=1), # 32, 8, 8
+                nn.ELU(inplace=True),
+                nn.ConvTranspose2d(32, 16, 3, stride=2, padding=1, output_padding=1), # 16, 16, 16
+                nn.ELU(inplace=True),
+                nn.ConvTranspose2d(16, 8, 3, stride=2, padding=1, output_padding=1), # 8, 32, 32
+                nn.ELU(inplace=True),
+                nn.ConvTranspose2d(8, 8, 3, stride=2, padding=1, output_padding=1), # 8, 64, 64
+                nn.ELU(inplace=True),
+                nn.Conv2d(8, self.obs_shape[0], 3, padding=1), # C, 64, 64
+            )
+        else: # mirrors the encoder, no output activation so it can reach every observation value
+            self.state_predictor_decoder = nn.Sequential(
+                nn.Linear(1024, 512),
+                nn.ELU(inplace=True),
+                nn.Linear(512, 256),
+                nn.ELU(inplace=True),
+                nn.Linear(256, obs_size),
+            )
+
+    def encode(self, x):
+        # [N, *obs_shape] -> [N, 512]
+        if self.encoder == "mlp":
+            x = x.reshape(x.shape[0], -1)
+        return self.representation_model_encoder(x).reshape(-1, 512)
+
     def compute_h(self, batch_size, device, a=None, h=None, z=None):
         if h is None: #starting new sequence
             h = torch.zeros((batch_size, 512)).to(device)
@@ -111,36 +238,32 @@ class WorldModel(nn.Module):
             z_logit:  logits of z_t
             z_sample: z_t
         """
-        embedding = self.representation_model_encoder(x)
-        embedding = embedding.reshape(-1, 512)
+        embedding = self.encode(x)
         embedding = torch.cat((h, embedding), dim=1)
         z_logits = self.representation_model_mlp(embedding)
-        z_sample = torch.distributions.one_hot_categorical.OneHotCategorical(logits=z_logits.reshape(-1, 32, 32)).sample()
-        z_probs = torch.softmax(z_logits.reshape(-1, 32, 32), dim=-1)
-        z_sample = z_sample + z_probs - z_probs.detach()
+        z_sample = sample_straight_through(z_logits.reshape(-1, 32, 32))
 
         return z_logits, z_sample
     
     def compute_z_hat_sample(self, z_hat_logits):
-        z_hat_sample = torch.distributions.one_hot_categorical.OneHotCategorical(logits=z_hat_logits.reshape(-1, 32, 32)).sample()
-        z_hat_probs = torch.softmax(z_hat_logits.reshape(-1, 32, 32), dim=-1)
-        
-        return z_hat_sample + z_hat_probs - z_hat_probs.detach()
+        return sample_straight_through(z_hat_logits.reshape(-1, 32, 32))
 
     def compute_x_hat(self, h_z):
         x_hat = self.x_hat_predictor_mlp(h_z)
-        # x_hat = x_hat.reshape(-1, 64, 4, 4)
-        return self.state_predictor_decoder(nn.Flatten()(x_hat))
+        if self.encoder == "conv":
+            return self.state_predictor_decoder(x_hat.reshape(-1, 64, 4, 4))
+        return self.state_predictor_decoder(x_hat).reshape(-1, *self.obs_shape)
 
     #using inference
-    def forward_inference(self, a, x, z, h):
+    def forward_inference(self, a, x, z, h, reset=None):
         h = self.compute_h(x.shape[0], x.device, a, h, z)
+        if reset is not None: # rows starting a new episode
+            h = h.masked_fill(reset.unsqueeze(1), 0)
 
-        embedding = self.representation_model_encoder(x)
-        embedding = embedding.reshape(-1, 512)
+        embedding = self.encode(x)
         embedding = torch.cat((h, embedding), dim=1)
         z_logits = self.representation_model_mlp(embedding)
-        z_sample = torch.distributions.one_hot_categorical.OneHotCategorical(logits=z_logits.reshape(-1, 32, 32)).sample()
+        z_sample = sample_one_hot(z_logits.reshape(-1, 32, 32))
         
         # no straight-though gradient
         return z_sample, h
@@ -190,6 +313,202 @@ class WorldModel(nn.Module):
         return z_logits, z_sample, z_hat_logits, x_hat, r_hat, gamma_hat, h, (z_hat_sample, r_hat_sample, gamma_hat_sample)
 
 
+    def observe_step(self, a, embedding, z, h):
+        h = self.gru(torch.cat((z.reshape(-1, 32*32), a), dim=1), h)
+        z_logits = self.representation_model_mlp(torch.cat((h, embedding), dim=1))
+        z_sample = self.compute_z_hat_sample(z_logits) # same straight-through sample as compute_z
+
+        return h, z_logits, z_sample
+
+    def observe_heads(self, h, z_sample):
+        h_z = torch.cat((h, z_sample), dim=1)
+
+        return (
+            self.transition_predictor(h),
+            self.r_predictor_mlp(h_z),
+            self.gamma_predictor_mlp(h_z),
+            self.compute_x_hat(h_z),
+        )
+
+    def observe(self, x, a, z=None, h=None, checkpoint=False):
+        """
+        Training pass over whole sequences. Only the GRU and the posterior run step by step,
+        the encoder and all heads run once over the B*T rows.
+        In:
+            x: [B, T, ...] observations
+            a: [B, T-1, num_action] if the sequences start here (h is None),
+               else [B, T, num_action] actions leading to each x_t from (z, h)
+            checkpoint: recompute the steps and heads during backward instead of keeping their activations
+        Out:
+            z_logits, z_sample, z_hat_logits, x_hat, r_hat, gamma_hat, h with leading dims [B, T]
+        """
+        B, T = x.shape[:2]
+        start = h is None
+        step, heads = self.observe_step, self.observe_heads
+        if checkpoint:
+            step = partial(torch.utils.checkpoint.checkpoint, step, use_reentrant=False)
+            heads = partial(torch.utils.checkpoint.checkpoint, heads, use_reentrant=False)
+
+        embedding = self.encode(x.reshape(B*T, *x.shape[2:])).reshape(B, T, 512)
+
+        h_list, z_logits_list, z_sample_list = [], [], []
+        for t in range(T):
+            if h is None:
+                h = self.compute_h(B, x.device)
+                z_logits = self.representation_model_mlp(torch.cat((h, embedding[:, t]), dim=1))
+                z = self.compute_z_hat_sample(z_logits)
+            else:
+                h, z_logits, z = step(a[:, t-1 if start else t], embedding[:, t], z, h)
+
+            h_list.append(h)
+            z_logits_list.append(z_logits)
+            z_sample_list.append(z)
+
+        h = torch.stack(h_list, dim=1).reshape(B*T, 512)
+        z_sample = torch.stack(z_sample_list, dim=1).reshape(B*T, 32*32)
+
+        z_hat_logits, r_hat, gamma_hat, x_hat = heads(h, z_sample)
+
+        return (
+            torch.stack(z_logits_list, dim=1),
+            z_sample.reshape(B, T, 32, 32),
+            z_hat_logits.reshape(B, T, -1),
+            x_hat.reshape(B, T, *x_hat.shape[1:]),
+            r_hat.reshape(B, T, 1),
+            gamma_hat.reshape(B, T, 1),
+            h.reshape(B, T, 512),
+        )
+
+    def gru_compact(self, index, probs, a, h, weight_t=None):
+        """
+        self.gru(cat((z, a)), h) with z given by its category indices, see latent_matmul.
+        weight_t: gru_latent_weight(), computed here if None
+        """
+        gru = self.gru
+        if weight_t is None:
+            weight_t = self.gru_latent_weight()
+        gi = latent_matmul(index, probs, weight_t)
+        dtype = gi.dtype
+        gi = gi + a.to(dtype) @ gru.weight_ih[:, 32*32:].t().to(dtype) + gru.bias_ih.to(dtype)
+        gh = h.to(dtype) @ gru.weight_hh.t().to(dtype) + gru.bias_hh.to(dtype)
+
+        i_r, i_z, i_n = gi.chunk(3, dim=1)
+        h_r, h_z, h_n = gh.chunk(3, dim=1)
+        r = torch.sigmoid(i_r + h_r)
+        update = torch.sigmoid(i_z + h_z)
+        n = torch.tanh(i_n + r * h_n)
+        return (1 - update) * n + update * h.to(dtype)
+
+    def gru_latent_weight(self):
+        # latent_weight() of the GRU input weights, where z comes first
+        weight = self.gru.weight_ih[:, :32*32]
+        if torch.is_autocast_enabled(weight.device.type):
+            weight = weight.to(torch.get_autocast_dtype(weight.device.type))
+        return weight.t().contiguous()
+
+    def imagine_compact(self, actor, z, h, H):
+        """
+        imagine() with the latents kept as int16 category indices. Every layer that reads
+        z gathers 32 weight columns instead of multiplying a dense one-hot, and only the
+        indices are stored. Same samples as imagine() for the same random state.
+        In:
+            z: [N, 32] int16 indices, or one-hot [N, 32, 32] / [N, 1024]
+            h: [N, 512]
+        Out:
+            z_index:          [H+1, N, 32] z_0 followed by the imagined latents
+            z_probs:          [H, N, 32, 32] softmax the imagined latents were sampled from,
+                              carries their straight-through gradient
+            h, a_sample, a_logits, r_hat_sample, gamma_hat_sample: as in imagine()
+        """
+        N = h.shape[0]
+        if z.is_floating_point():
+            z = compress_latent(z)
+        probs = None
+
+        z_out = z.new_empty((H+1, N, 32))
+        probs_out = []
+        h_out = h.new_empty((H+1, N, 512))
+        a_out = h.new_empty((H, N, self.num_action))
+        a_logits_out = h.new_empty((H, N, self.num_action))
+        r_out = h.new_empty((H, N, 1))
+        gamma_out = h.new_empty((H, N, 1))
+
+        # transposed latent weights, once per rollout instead of once per step
+        weight_gru = self.gru_latent_weight()
+        weight_r = latent_weight(self.r_predictor_mlp[0])
+        weight_gamma = latent_weight(self.gamma_predictor_mlp[0])
+
+        z_out[0] = z
+        h_out[0] = h
+        for t in range(H):
+            a_logits = actor(z, probs)
+            a = sample_straight_through(a_logits)
+
+            h = self.gru_compact(z, probs, a, h, weight_gru)
+            z_hat_logits = self.transition_predictor(h).reshape(N, 32, 32).float()
+            z = sample_one_hot(z_hat_logits).argmax(dim=-1).to(torch.int16)
+            probs = torch.softmax(z_hat_logits, dim=-1)
+
+            r_hat = self.r_predictor_mlp[1:](latent_linear(self.r_predictor_mlp[0], z, probs, h, weight_r))
+            gamma_hat = self.gamma_predictor_mlp[1:](latent_linear(self.gamma_predictor_mlp[0], z, probs, h, weight_gamma))
+
+            z_out[t+1] = z
+            probs_out.append(probs)
+            h_out[t+1] = h
+            a_out[t] = a
+            a_logits_out[t] = a_logits
+            r_out[t] = r_hat.detach()
+            gamma_out[t] = (torch.rand_like(gamma_hat) < torch.sigmoid(gamma_hat)).float() * self.gamma #Bernoulli in {0,1}
+
+        return z_out, torch.stack(probs_out), h_out, a_out, a_logits_out, r_out, gamma_out
+
+    def imagine(self, actor, z, h, H):
+        """
+        H-step dream rollout from the start states (z, h) with actions from actor.
+        Plain tensor ops only so the rollout can go through torch.compile.
+        In:
+            z: [N, 32, 32] or [N, 1024]
+            h: [N, 512]
+        Out:
+            z_hat_sample:     [H+1, N, 1024] z_0 followed by the imagined latents
+            h:                [H+1, N, 512]
+            a_sample:         [H, N, num_action] straight-through actions
+            a_logits:         [H, N, num_action]
+            r_hat_sample:     [H, N, 1]
+            gamma_hat_sample: [H, N, 1]
+        """
+        N = h.shape[0]
+        z = z.reshape(N, 32*32)
+
+        z_out = z.new_empty((H+1, N, 32*32))
+        h_out = h.new_empty((H+1, N, 512))
+        a_out = h.new_empty((H, N, self.num_action))
+        a_logits_out = h.new_empty((H, N, self.num_action))
+        r_out = h.new_empty((H, N, 1))
+        gamma_out = h.new_empty((H, N, 1))
+
+        z_out[0] = z
+        h_out[0] = h
+        for t in range(H):
+            a_logits = actor(z)
+            a = sample_straight_through(a_logits)
+
+            h = self.gru(torch.cat((z, a), dim=1), h)
+            z = sample_straight_through(self.transition_predictor(h).reshape(N, 32, 32)).reshape(N, 32*32)
+
+            h_z = torch.cat((h, z), dim=1)
+            r_hat = self.r_predictor_mlp(h_z)
+            gamma_hat = self.gamma_predictor_mlp(h_z)
+
+            z_out[t+1] = z
+            h_out[t+1] = h
+            a_out[t] = a
+            a_logits_out[t] = a_logits
+            r_out[t] = r_hat.detach()
+            gamma_out[t] = (torch.rand_like(gamma_hat) < torch.sigmoid(gamma_hat)).float() * self.gamma #Bernoulli in {0,1}
+
+        return z_out, h_out, a_out, a_logits_out, r_out, gamma_out
+
     def forward(self, a, x, z, h=None, dream=False, inference=False):
         if inference: # only use embedding network, i.e. no image predictor
             return self.forward_inference(a, x, z, h)
@@ -213,7 +532,10 @@ class Actor(nn.Module):
             nn.Tanh()
         )
 
-    def forward(self, z_sample):
+    def forward(self, z_sample, probs=None):
+        # z_sample may also be int16 category indices [N, 32] with the probs they were sampled from
+        if not z_sample.is_floating_point():
+            return self.model[1:](latent_linear(self.model[0], z_sample, probs))*2
         z_sample = z_sample.reshape(-1, 32*32)
         return self.model(z_sample)*2
 
@@ -229,11 +551,25 @@ class Critic(nn.Module):
             nn.Linear(256, 1),
         )
 
-    def forward(self, z_sample):
+    def forward(self, z_sample, probs=None):
+        if not z_sample.is_floating_point(): # int16 category indices, see Actor
+            return self.model[1:](latent_linear(self.model[0], z_sample, probs))
         z_sample = z_sample.reshape(-1, 32*32)
         return self.model(z_sample)
 
+def sum_over_steps(x):
+    # mean over everything but the time dim 1, summed over time; 0 for an empty sequence
+    return x.sum() / max(x[:, :1].numel(), 1)
+
 class LossModel(nn.Module):
+    """
+    World-model loss of whole sequences: the negative log-likelihoods of the
+    observations (unit Gaussian), rewards (unit Gaussian) and discounts (Bernoulli),
+    of the posterior sample under the prior (transition) and, with the posterior
+    logits detached, under the posterior, which carries no gradient. Every term
+    is the mean over the batch and the elements of one step, summed over the
+    steps, in closed form and without leaving the device.
+    """
     def __init__(self, nx=1/64/64/3, nr=1, ng=1, nt=0.08, nq=0.1):
         super(LossModel, self).__init__()
 
@@ -244,23 +580,37 @@ class LossModel(nn.Module):
         self.nq = nq
 
     def forward(self, x, r, gamma, z_logits, z_sample, x_hat, r_hat, gamma_hat, z_hat_logits):
-        x_dist = torch.distributions.normal.Normal(loc=x_hat, scale=1.0)
-        r_dist = torch.distributions.normal.Normal(loc=r_hat, scale=1.0)
-        gamma_dist = torch.distributions.bernoulli.Bernoulli(logits=gamma_hat)
-        z_hat_dist = torch.distributions.one_hot_categorical.OneHotCategorical(logits=z_hat_logits.reshape(-1, 32, 32))
-        z_dist = torch.distributions.one_hot_categorical.OneHotCategorical(logits=z_logits.reshape(-1, 32, 32).detach())
-        
-        print (z_sample.shape)
-        z_sample = z_sample.reshape(-1, 32, 32)
-        print (z_sample.shape)
-
-        loss = -self.nx*x_dist.log_prob(x).mean().item() \
-                -self.nr*r_dist.log_prob(r).mean().item() \
-                -self.ng*gamma_dist.log_prob(gamma.round()).mean().item() \
-                -self.nt*z_hat_dist.log_prob(z_sample.detach()).mean().item() \
-                +self.nq*z_dist.log_prob(z_sample).mean().item()
-
-        return loss
+        """
+        In:
+            x, x_hat:               [B, T, *obs_shape]
+            z_logits, z_hat_logits: [B, T, 1024] posterior and prior logits
+            z_sample:               [B, T, 32, 32] posterior samples
+            r, r_hat:               [B, T', 1] rewards and predictions of the steps that have one,
+            gamma, gamma_hat:       [B, T', 1] discounts and logits, T' is T-1 if the sequences start here
+        Out:
+            loss:  differentiable scalar
+            terms: dict of the detached weighted terms, summing to loss
+        """
+        B, T = z_logits.shape[:2]
+        # log-probs in fp32 even if the predictions come out of autocast. Like OneHotCategorical.log_prob,
+        # which reads the sample through an argmax, neither categorical term differentiates the sample
+        z_sample = z_sample.detach().float().reshape(B, T, 32, 32)
+        log_p = torch.log_softmax(z_hat_logits.float().reshape(B, T, 32, 32), dim=-1)
+        log_q = torch.log_softmax(z_logits.detach().float().reshape(B, T, 32, 32), dim=-1)
+        half_log_2pi = 0.5 * math.log(2 * math.pi)
+
+        terms = {
+            "obs": self.nx * sum_over_steps(0.5 * (x.float() - x_hat.float())**2 + half_log_2pi),
+            "reward": self.nr * sum_over_steps(0.5 * (r.float() - r_hat.float())**2 + half_log_2pi),
+            "discount": self.ng * sum_over_steps(nn.functional.binary_cross_entropy_with_logits(
+                gamma_hat.float(), gamma.float().round(), reduction="none"
+            )),
+            "transition": -self.nt * sum_over_steps((z_sample * log_p).sum(dim=-1)),
+            "posterior": self.nq * sum_over_steps((z_sample * log_q).sum(dim=-1)),
+        }
+        loss = sum(terms.values())
+
+        return loss, {k: v.detach() for k, v in terms.items()}
 
 class ActorLoss(nn.Module):
     def __init__(self, ns=0.9, nd=0.1, ne=3e-3):
@@ -272,18 +622,25 @@ class ActorLoss(nn.Module):
 
         self.anneal = 1e-5
 
-    def forward(self, a, dist_a, V, ve):
-        print (a.shape)
-        print (dist_a.shape)
-        print (V.shape)
-        print (ve.shape)
+    def forward(self, a, a_logits, V, ve):
+        """
+        In:
+            a:        [H, N, num_actions] one-hot actions
+            a_logits: [H, N, num_actions]
+            V, ve:    [H, N, 1] lambda-returns and critic values
+        """
+        log_probs = torch.log_softmax(a_logits.float(), dim=-1)
+        log_prob = log_probs.gather(-1, a.detach().argmax(dim=-1, keepdim=True)).squeeze(-1)
+        entropy = -(log_probs.exp() * log_probs).sum(dim=-1)
         
-        loss = -self.ns * dist_a.log_prob(a) * (V - ve).detach().squeeze(-1)\
+        loss = -self.ns * log_prob * (V - ve).detach().squeeze(-1)\
             -self.nd * V.squeeze(-1)\
-            -self.ne * dist_a.entropy()
+            -self.ne * entropy
 
-        self.nd = max(0, self.nd - self.anneal)
-        self.ne = max(3e-4, self.ne - self.anneal)
+        # anneal once per imagined step
+        steps = a.shape[0] if a.dim() > 2 else 1
+        self.nd = max(0, self.nd - self.anneal*steps)
+        self.ne = max(3e-4, self.ne - self.anneal*steps)
 
         return loss.mean()
 
@@ -0,0 +1,117 @@
+import queue
+import threading
+from time import perf_counter
+
+import torch
+
+class Prefetcher:
+    """
+    Prepares the next batches of a SequenceSampler on a background thread while the
+    current one trains.
+
+    depth+1 buffer sets from sampler.allocate rotate between the thread and the
+    consumer: up to depth filled ones wait in a bounded queue and one is in use.
+    A batch returned by get is valid until the next call to get. On CUDA the
+    thread also copies each batch to the device on its own stream, so the host
+    buffers go back to the thread as soon as the copy is done.
+
+    Batches are drawn up to depth updates before they are trained on, so loss
+    priorities set by update_priorities apply a few batches later than without
+    prefetching.
+
+    Every get that finds no batch ready counts as a starvation, see stats().
+    """
+    def __init__(self, sampler, depth=2, device="cpu"):
+        self.sampler = sampler
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+
+        self.free = queue.Queue() #buffer sets the thread can fill
+        for _ in range(depth + 1):
+            self.free.put(sampler.allocate())
+        self.ready = queue.Queue(maxsize=depth) #(buffers, batch, info) waiting for get
+        self.current = None #buffers of the batch returned by the last get
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.batches = 0
+        self.starved = 0 #calls to get that had to wait for a batch
+        self.wait_time = 0.0 #seconds spent waiting in those calls
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                try:
+                    buffers = self.free.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                batch, info = self.sampler.sample_into(buffers)
+                if self.stream is not None:
+                    with torch.cuda.stream(self.stream):
+                        batch = tuple(x.to(self.device, non_blocking=True) for x in batch)
+                    self.stream.synchronize()
+                    self.free.put(buffers) # host copy no longer needed
+                    buffers = None
+                self.put((buffers, batch, info))
+        except Exception as e: # raised again by get
+            self.put((None, e, None))
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.ready.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self):
+        """
+        Out:
+            batch: (states, actions, rewards, gammas) as returned by sampler.sample,
+                   on the device
+            info:  as returned by sampler.sample_into
+        """
+        if self.current is not None: # the previous batch is done with
+            self.free.put(self.current)
+            self.current = None
+
+        try:
+            buffers, batch, info = self.ready.get_nowait()
+        except queue.Empty:
+            self.starved += 1
+            start = perf_counter()
+            buffers, batch, info = self.ready.get()
+            self.wait_time += perf_counter() - start
+        if isinstance(batch, Exception):
+            raise batch
+
+        self.current = buffers
+        self.batches += 1
+        if self.stream is not None: # tensors allocated on the prefetch stream are used on the current one
+            for x in batch:
+                x.record_stream(torch.cuda.current_stream(self.device))
+        return batch, info
+
+    def stats(self):
+        """
+        Fraction of get calls that had to wait and ms waited per call since the last
+        call to stats.
+        """
+        batches = max(self.batches, 1)
+        stats = {
+            "prefetch_starved": self.starved / batches,
+            "prefetch_wait_ms": 1000 * self.wait_time / batches,
+        }
+        self.batches, self.starved, self.wait_time = 0, 0, 0.0
+        return stats
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,67 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+LUMA = torch.tensor([0.299, 0.587, 0.114]) # ITU-R 601 weights of R, G and B
+
+def grayscale(frames):
+    """
+    In:
+        frames: [N, 3, H, W] float
+    Out:
+        frames: [N, 1, H, W]
+    """
+    return torch.einsum("nchw,c->nhw", frames, LUMA.to(frames.dtype)).unsqueeze(1)
+
+def downsample(frames, size):
+    # [N, C, H, W] -> [N, C, size, size], every output pixel is the mean of the input pixels it covers
+    return nn.functional.interpolate(frames, size=(size, size), mode="area")
+
+class Preprocessor:
+    """
+    Turns batches of raw observations from the environments into what the replay
+    stores, uint8 throughout, and the stored observations into model inputs.
+
+    RAM:    [N, 128] bytes are kept as they are.
+    Pixels: [N, H, W, 3] frames are converted to grayscale (optionally) and
+            downsampled to [N, 1 or 3, size, size], one vectorized call per batch.
+
+    to_float only runs on the batches the models see, e.g. after a sampled batch
+    reached the device, so the replay never holds float observations.
+    """
+    def __init__(self, pixels=False, size=64, gray=True):
+        self.pixels = pixels
+        self.size = size
+        self.gray = gray
+
+    def obs_shape(self, raw_shape):
+        # shape of one stored observation given the shape the environment returns
+        if not self.pixels:
+            return tuple(raw_shape)
+        return (1 if self.gray else 3, self.size, self.size)
+
+    def __call__(self, obs):
+        """
+        In:
+            obs: [N, *raw_shape] batch of raw observations
+        Out:
+            obs: [N, *obs_shape] uint8 numpy array
+        """
+        if not self.pixels:
+            return np.asarray(obs, dtype=np.uint8)
+
+        x = torch.from_numpy(np.ascontiguousarray(obs)).permute(0, 3, 1, 2).float()
+        if self.gray:
+            x = grayscale(x)
+        if x.shape[2:] != (self.size, self.size):
+            x = downsample(x, self.size)
+        return x.round_().clamp_(0, 255).to(torch.uint8).numpy()
+
+    def to_float(self, obs):
+        # uint8 tensor of stored observations -> float model input centered at 0
+        obs = obs.float()
+        return obs / 255 - 0.5 if self.pixels else obs - 255/2
+
+    def transform(self, obs):
+        # raw batch -> model input in one go, e.g. for serving
+        return self.to_float(torch.from_numpy(self(obs)))
@@ -0,0 +1,181 @@
+from collections import deque
+
+import numpy as np
+
+from .dataset import SequenceSampler
+
+class SumTree:
+    """
+    Binary tree over `capacity` non-negative leaf priorities where every node holds
+    the sum of its children. Setting a batch of leaves and drawing a batch of leaves
+    proportionally to their priority both cost O(B log N), one numpy call per level.
+    """
+    def __init__(self, capacity):
+        self.capacity = 1 << max(int(capacity) - 1, 1).bit_length() #leaves, rounded up to a power of two
+        self.depth = self.capacity.bit_length() - 1
+        self.tree = np.zeros(2*self.capacity, dtype=np.float64) #node i has children 2i and 2i+1, leaves start at capacity
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def get(self, leaves):
+        return self.tree[self.capacity + np.asarray(leaves)]
+
+    def set(self, leaves, priorities):
+        nodes = self.capacity + np.asarray(leaves, dtype=np.int64)
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes >> 1)
+            self.tree[nodes] = self.tree[2*nodes] + self.tree[2*nodes + 1]
+
+    def rebuild(self):
+        for level in range(self.depth - 1, -1, -1):
+            nodes = np.arange(1 << level, 2 << level)
+            self.tree[nodes] = self.tree[2*nodes] + self.tree[2*nodes + 1]
+
+    def sample(self, batch_size):
+        """
+        Stratified draw: one leaf from each of batch_size equal slices of the total priority.
+        """
+        mass = (np.arange(batch_size) + np.random.random_sample(batch_size)) * (self.total / batch_size)
+        nodes = np.ones(batch_size, dtype=np.int64)
+        for _ in range(self.depth):
+            left = self.tree[2*nodes]
+            right = mass >= left
+            mass -= left * right
+            nodes = 2*nodes + right
+        # float round-off can end on an empty leaf, step back to one that is set
+        leaves = nodes - self.capacity
+        empty = self.tree[nodes] <= 0
+        if empty.any():
+            valid = np.flatnonzero(self.tree[self.capacity:] > 0)
+            leaves[empty] = valid[np.minimum(np.searchsorted(valid, leaves[empty]), len(valid) - 1)]
+        return leaves
+
+class PrioritizedSampler(SequenceSampler):
+    """
+    SequenceSampler that draws windows from a SumTree over their start positions
+    instead of episodes uniformly, so every transition is equally likely to start
+    a window no matter how long its episode is.
+
+    Modes:
+        "uniform": every window start has the same priority.
+        "recency": priorities halve every half_life collected env steps.
+        "loss":    priority (loss + eps)^alpha, set by update_priorities after
+                   training on the batch. New windows get the highest priority seen.
+
+    Leaves are handed out to the windows of new episodes round-robin. capacity is
+    only the initial number of leaves: when the next leaves are still held by
+    episodes in the replay, e.g. an EpisodeStore larger than capacity steps, the
+    tree doubles instead of dropping them. Episodes are synced from the replay on
+    every sample by their ids.
+    """
+    def __init__(self, replay, batch_size, seq_len, gamma, mode="uniform", capacity=2**18,
+                 alpha=0.6, eps=1e-3, half_life=1e5, pin_memory=False):
+        super(PrioritizedSampler, self).__init__(replay, batch_size, seq_len, gamma, pin_memory=pin_memory)
+        if mode not in ("uniform", "recency", "loss"):
+            raise ValueError("unknown sampling mode %r" % mode)
+        self.mode = mode
+        self.alpha = alpha
+        self.eps = eps
+        self.half_life = half_life
+
+        self.tree = SumTree(capacity)
+        self.leaf_episode = np.full(self.tree.capacity, -1, dtype=np.int64) #id of the episode a leaf belongs to
+        self.leaf_offset = np.zeros(self.tree.capacity, dtype=np.int64) #window start within the episode
+        self.head = 0 #next leaf handed out
+        self.synced = None #id of the first episode not in the tree yet
+        self.episodes = deque() #(id, leaves) of the episodes in the tree, oldest first
+
+        self.max_priority = 1.0
+        self.recency_origin = 0 #collected steps at which the recency weight is 1
+
+
+    def insert(self, episode_id, length, collected):
+        count = length - self.seq_len + 1
+        if count <= 0:
+            return
+        leaves = (self.head + np.arange(count)) % self.tree.capacity
+        if count > self.tree.capacity or (self.leaf_episode[leaves] >= 0).any():
+            self.grow(max(2*self.tree.capacity, self.tree.capacity + count))
+            leaves = self.head + np.arange(count)
+        self.head = (self.head + count) % self.tree.capacity
+
+        if self.mode == "recency":
+            priority = self.recency_weight(collected)
+        else:
+            priority = self.max_priority if self.mode == "loss" else 1.0
+        self.leaf_episode[leaves] = episode_id
+        self.leaf_offset[leaves] = np.arange(count)
+        self.tree.set(leaves, priority)
+        self.episodes.append((episode_id, leaves))
+
+    def grow(self, capacity):
+        # more leaves, existing ones keep their index and the new ones are handed out next
+        tree = SumTree(capacity)
+        tree.tree[tree.capacity:tree.capacity + self.tree.capacity] = self.tree.tree[self.tree.capacity:]
+        tree.rebuild()
+        pad = tree.capacity - self.tree.capacity
+        self.leaf_episode = np.concatenate([self.leaf_episode, np.full(pad, -1, dtype=np.int64)])
+        self.leaf_offset = np.concatenate([self.leaf_offset, np.zeros(pad, dtype=np.int64)])
+        self.head = self.tree.capacity
+        self.tree = tree
+
+    def remove(self, episode_id, leaves):
+        leaves = leaves[self.leaf_episode[leaves] == episode_id] #some may have been handed out again
+        self.leaf_episode[leaves] = -1
+        self.tree.set(leaves, 0.0)
+
+    def recency_weight(self, collected):
+        exponent = (collected - self.recency_origin) / self.half_life
+        if exponent > 500: # rescale before the weights overflow
+            self.tree.tree[self.tree.capacity:] *= 2.0**-exponent
+            self.tree.rebuild()
+            self.recency_origin = collected
+            exponent = 0.0
+        return 2.0**exponent
+
+    def sync(self, lengths):
+        first_id = self.replay.first_id
+        while self.episodes and self.episodes[0][0] < first_id: # evicted from the replay
+            self.remove(*self.episodes.popleft())
+
+        if self.synced is None:
+            self.synced = first_id
+        new = lengths[max(self.synced, first_id) - first_id:]
+        # collected steps at the end of each new episode
+        collected = self.replay.collected - (new.sum() - np.cumsum(new))
+        for i, episode_id in enumerate(range(max(self.synced, first_id), self.replay.added)):
+            self.insert(episode_id, new[i], collected[i])
+        self.synced = self.replay.added
+
+    def draw(self):
+        lengths = self.replay.episode_lengths()
+        self.sync(lengths)
+        if self.tree.total <= 0:
+            raise ValueError("no episode with at least %d transitions in replay" % self.seq_len)
+
+        leaves = self.tree.sample(self.batch_size)
+        leaf_ids = self.leaf_episode[leaves]
+        # the leaves go with the batch, for update_priorities
+        return leaf_ids - self.replay.first_id, self.leaf_offset[leaves], {"leaves": leaves, "leaf_ids": leaf_ids}
+
+    def update_priorities(self, losses, info=None):
+        """
+        Sets the priority of the windows of the last batch of sample, or of the batch
+        sample_into returned info for, from their losses. Leaves handed to another
+        window since are skipped.
+        In:
+            losses: [B] loss per sequence
+        """
+        if self.mode != "loss":
+            return
+        info = self.info if info is None else info
+        leaves, leaf_ids = info["leaves"], info["leaf_ids"]
+
+        priorities = (np.maximum(np.asarray(losses, dtype=np.float64), 0) + self.eps) ** self.alpha
+        with self.replay.lock:
+            current = self.leaf_episode[leaves] == leaf_ids
+            self.tree.set(leaves[current], priorities[current])
+        self.max_priority = max(self.max_priority, float(priorities.max()))
@@ -0,0 +1,601 @@
+from collections import deque
+import json
+import os
+import threading
+
+import numpy as np
+
+class ReplayBuffer:
+    """
+    Fixed-capacity ring buffer of episodes stored as structure-of-arrays.
+
+    Every step of an episode occupies one slot: slot k holds obs_k together
+    with the action taken at obs_k and the reward/done that followed it. An
+    episode with T transitions therefore takes T+1 slots, the last one having
+    an unused action/reward/done. Episodes are contiguous modulo capacity and
+    the oldest ones are evicted in O(1) when space is needed.
+    """
+    def __init__(self, capacity, obs_shape, num_actions, obs_dtype=np.float32):
+        self.capacity = capacity
+        self.obs_shape = tuple(obs_shape)
+        self.num_actions = num_actions
+        self.obs_dtype = np.dtype(obs_dtype)
+
+        self.obs = np.zeros((capacity, *obs_shape), dtype=obs_dtype)
+        self.actions = np.zeros(capacity, dtype=np.int64)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.dones = np.zeros(capacity, dtype=np.bool_)
+
+        self.starts = deque() #first slot of each stored episode
+        self.lengths = deque() #number of transitions of each stored episode
+        self.versions = deque() #policy version each episode was collected with
+        self.first_steps = deque() #step id of the first observation of each stored episode
+        self.head = 0 #next free slot
+        self.used = 0 #occupied slots
+        self.steps = 0 #stored transitions
+        self.collected = 0 #transitions ever added, evicted ones included
+        self.added = 0 #id of the next episode, ids increase by one per added episode
+        self.first_id = 0 #id of the oldest stored episode
+        self.next_step = 0 #step id of the next added observation, ids increase by one per observation
+        self.pending = {} #collector name -> its in-progress episodes, never sampled
+
+        self.lock = threading.RLock()
+        self.episode_added = threading.Condition(self.lock)
+
+    @property
+    def num_episodes(self):
+        return len(self.starts)
+
+    def wait_for(self, predicate, timeout=None):
+        # blocks until predicate() holds, checked again whenever an episode is added
+        with self.episode_added:
+            return self.episode_added.wait_for(predicate, timeout)
+
+    @property
+    def num_steps(self):
+        return self.steps
+
+    @property
+    def nbytes(self):
+        return self.obs.nbytes + self.actions.nbytes + self.rewards.nbytes + self.dones.nbytes
+
+    def episode_lengths(self):
+        with self.lock:
+            return np.fromiter(self.lengths, dtype=np.int64, count=len(self.lengths))
+
+    def episode_versions(self):
+        with self.lock:
+            return np.fromiter(self.versions, dtype=np.int64, count=len(self.versions))
+
+    def episode_first_steps(self):
+        with self.lock:
+            return np.fromiter(self.first_steps, dtype=np.int64, count=len(self.first_steps))
+
+    def add_episode(self, obs, actions, rewards, dones, version=0):
+        """
+        In:
+            obs:     [T+1, *obs_shape]
+            actions: [T] action indices
+            rewards: [T]
+            dones:   [T]
+            version: policy version used to collect the episode
+        """
+        size = len(obs)
+        assert size == len(actions) + 1, "episode needs one more observation than transitions"
+        assert size <= self.capacity, "episode does not fit in replay buffer"
+
+        with self.lock:
+            slots = (self.head + np.arange(size)) % self.capacity # head only moves under the lock
+            while self.used + size > self.capacity: #evict oldest episodes
+                self.starts.popleft()
+                self.versions.popleft()
+                self.first_steps.popleft()
+                length = self.lengths.popleft()
+                self.used -= length + 1
+                self.steps -= length
+                self.first_id += 1
+
+            self.obs[slots] = obs
+            self.actions[slots[:-1]] = actions
+            self.rewards[slots[:-1]] = rewards
+            self.dones[slots[:-1]] = dones
+
+            self.starts.append(self.head)
+            self.lengths.append(size - 1)
+            self.versions.append(version)
+            self.first_steps.append(self.next_step)
+            self.next_step += size
+            self.head = (self.head + size) % self.capacity
+            self.used += size
+            self.steps += size - 1
+            self.collected += size - 1
+            self.added += 1
+            self.episode_added.notify_all()
+
+    def set_pending(self, name, episodes):
+        # latest snapshot of the in-progress episodes of one collector, see VectorCollector
+        with self.lock:
+            self.pending[name] = episodes
+
+    def pending_episodes(self):
+        with self.lock:
+            return [episode for episodes in self.pending.values() for episode in episodes]
+
+    def renumber(self, next_id):
+        # continue episode ids from next_id, e.g. after restoring persisted episodes
+        with self.lock:
+            self.added = next_id
+            self.first_id = next_id - self.num_episodes
+
+    def export_episodes(self, since):
+        """
+        Copies of the stored episodes with id >= since.
+        Out:
+            episodes: list of (id, dict of obs, actions, rewards, dones, version)
+            first_id: id of the oldest stored episode
+        """
+        with self.lock:
+            episodes = []
+            for episode_id in range(max(since, self.first_id), self.added):
+                e = episode_id - self.first_id
+                slots = (self.starts[e] + np.arange(self.lengths[e] + 1)) % self.capacity
+                episodes.append((episode_id, {
+                    "obs": self.obs[slots],
+                    "actions": self.actions[slots[:-1]],
+                    "rewards": self.rewards[slots[:-1]],
+                    "dones": self.dones[slots[:-1]],
+                    "version": self.versions[e],
+                }))
+            return episodes, self.first_id
+
+    def last_episode_reward(self):
+        start, length = self.starts[-1], self.lengths[-1]
+        return float(self.rewards[(start + np.arange(length)) % self.capacity].sum())
+
+    def gather(self, episodes, offsets, seq_len, out=None):
+        """
+        In:
+            episodes: [B] episode indices (0 is the oldest stored episode)
+            offsets:  [B] first transition of each window inside its episode
+            out:      optional (obs, actions, rewards, dones) arrays to fill
+        Out:
+            obs:     [B, seq_len+1, *obs_shape]
+            actions: [B, seq_len] action indices
+            rewards: [B, seq_len]
+            dones:   [B, seq_len]
+        """
+        if out is None:
+            out = (None, None, None, None)
+
+        with self.lock:
+            starts = np.fromiter(self.starts, dtype=np.int64, count=len(self.starts))
+            starts = starts[episodes] + offsets
+            slots = (starts[:, None] + np.arange(seq_len + 1)) % self.capacity
+
+            return (
+                np.take(self.obs, slots, axis=0, out=out[0]),
+                np.take(self.actions, slots[:, :-1], axis=0, out=out[1]),
+                np.take(self.rewards, slots[:, :-1], axis=0, out=out[2]),
+                np.take(self.dones, slots[:, :-1], axis=0, out=out[3]),
+            )
+
+class EpisodeStore:
+    """
+    On-disk episode store with the same interface as ReplayBuffer.
+
+    Episodes are appended to fixed-size segments, one memory-mapped .npy file per
+    field, and never span two segments. An index.json lists the segments and the
+    (segment, start, length, version) of every episode so the store can be reopened after a
+    restart. Whole segments are evicted, oldest first, once the store exceeds
+    max_bytes on disk. Episode and step ids are kept in the index as well, so they
+    hold across restarts and for EpisodeFollowers of the store.
+
+    Rewriting the index costs time in the number of stored episodes, so it is only
+    rewritten when a segment is added or evicted, on flush and every index_interval
+    episodes. The episodes added in between are appended to a log, one JSON line
+    each, that the index names and a rewrite replaces.
+    """
+    fields = ("obs", "actions", "rewards", "dones")
+
+    def __init__(self, directory, obs_shape, num_actions, obs_dtype=np.float32,
+                 segment_steps=2**16, max_bytes=8*2**30, index_interval=1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_interval = index_interval
+        self.log = None #open log of the current index
+        self.log_name = None
+        self.logged = 0 #episodes in the log
+
+        self.segments = {} #segment id -> dict of field memmaps
+        self.episode_segments = []
+        self.episode_starts = []
+        self.episode_lengths_ = []
+        self.episode_versions_ = []
+        self.episode_first_steps_ = [] #step id of the first observation of each episode
+        self.steps = 0
+        self.next_step = 0 #step id of the next added observation
+        self.collected = 0 #transitions added since the store was opened
+        self.added = 0 #id of the next episode
+        self.first_id = 0 #id of the oldest stored episode
+        self.pending = {} #collector name -> its in-progress episodes, see ReplayBuffer.set_pending
+
+        self.lock = threading.RLock()
+        self.episode_added = threading.Condition(self.lock)
+
+        os.makedirs(directory, exist_ok=True)
+        if os.path.isfile(self.index_path):
+            self.load_index()
+        else:
+            self.obs_shape = tuple(obs_shape)
+            self.obs_dtype = np.dtype(obs_dtype)
+            self.num_actions = num_actions
+            self.segment_steps = segment_steps
+            self.next_segment = 0
+            self.head = segment_steps #forces a new segment on first write
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, "index.json")
+
+    @property
+    def num_episodes(self):
+        return len(self.episode_starts)
+
+    def wait_for(self, predicate, timeout=None):
+        with self.episode_added:
+            return self.episode_added.wait_for(predicate, timeout)
+
+    @property
+    def num_steps(self):
+        return self.steps
+
+    @property
+    def segment_bytes(self):
+        return self.segment_steps * (self.obs_dtype.itemsize * int(np.prod(self.obs_shape)) + 8 + 4 + 1)
+
+    @property
+    def nbytes(self):
+        return len(self.segments) * self.segment_bytes
+
+    def episode_lengths(self):
+        with self.lock:
+            return np.array(self.episode_lengths_, dtype=np.int64)
+
+    def episode_versions(self):
+        with self.lock:
+            return np.array(self.episode_versions_, dtype=np.int64)
+
+    def episode_first_steps(self):
+        with self.lock:
+            return np.array(self.episode_first_steps_, dtype=np.int64)
+
+    def set_pending(self, name, episodes):
+        with self.lock:
+            self.pending[name] = episodes
+
+    def pending_episodes(self):
+        with self.lock:
+            return [episode for episodes in self.pending.values() for episode in episodes]
+
+    def segment_path(self, segment, field):
+        return os.path.join(self.directory, "%06d.%s.npy" % (segment, field))
+
+    def open_segment(self, segment, mode):
+        self.segments[segment] = {
+            field: np.load(self.segment_path(segment, field), mmap_mode=mode)
+            for field in self.fields
+        }
+
+    def new_segment(self):
+        if self.segments: #seal the active segment
+            for array in self.segments[self.next_segment - 1].values():
+                array.flush()
+
+        segment = self.next_segment
+        shapes = {
+            "obs": ((self.segment_steps, *self.obs_shape), self.obs_dtype),
+            "actions": ((self.segment_steps,), np.int64),
+            "rewards": ((self.segment_steps,), np.float32),
+            "dones": ((self.segment_steps,), np.bool_),
+        }
+        self.segments[segment] = {
+            field: np.lib.format.open_memmap(self.segment_path(segment, field), mode="w+", shape=shape, dtype=dtype)
+            for field, (shape, dtype) in shapes.items()
+        }
+        self.next_segment += 1
+        self.head = 0
+
+    def evict(self):
+        while len(self.segments) > 1 and len(self.segments) * self.segment_bytes > self.max_bytes:
+            segment = min(self.segments)
+            del self.segments[segment]
+
+            count = self.episode_segments.count(segment) #episodes are stored in segment order
+            self.steps -= sum(self.episode_lengths_[:count])
+            del self.episode_segments[:count]
+            del self.episode_starts[:count]
+            del self.episode_lengths_[:count]
+            del self.episode_versions_[:count]
+            del self.episode_first_steps_[:count]
+            self.first_id += count
+
+            for field in self.fields:
+                os.remove(self.segment_path(segment, field))
+
+    def read_log(self, name, offset=0):
+        # complete records of a log from byte offset on, and the offset after them
+        try:
+            with open(os.path.join(self.directory, name), "rb") as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError: # replaced by a newer index
+            return [], offset
+        end = data.rfind(b"\n") + 1 # the last line may still be written
+        return [json.loads(line) for line in data[:end].splitlines()], offset + end
+
+    def load_index(self):
+        with open(self.index_path) as f:
+            index = json.load(f)
+
+        self.obs_shape = tuple(index["obs_shape"])
+        self.obs_dtype = np.dtype(index["obs_dtype"])
+        self.num_actions = index["num_actions"]
+        self.segment_steps = index["segment_steps"]
+        self.next_segment = index["next_segment"]
+        self.head = index["head"]
+
+        for segment in index["segments"]:
+            self.open_segment(segment, "r+" if segment == self.next_segment - 1 else "r")
+        self.first_id = self.added = index.get("first_id", 0) # ids restart from 0 in older indexes
+        self.next_step = index.get("first_step", 0)
+        self.append_episodes(index["episodes"])
+        if index.get("log") is not None:
+            episodes, _ = self.read_log(index["log"])
+            self.append_episodes(episodes)
+            for segment, start, length, _ in episodes:
+                if segment == self.next_segment - 1:
+                    self.head = start + length + 1
+            self.log_name = index["log"]
+        self.save_index() # a fresh log, a crash may have left a partial line in the old one
+
+    def append_episodes(self, episodes):
+        # (segment, start, length, version) entries of an index
+        for segment, start, length, version in episodes:
+            self.episode_segments.append(segment)
+            self.episode_starts.append(start)
+            self.episode_lengths_.append(length)
+            self.episode_versions_.append(version)
+            self.episode_first_steps_.append(self.next_step)
+            self.next_step += length + 1
+            self.steps += length
+            self.added += 1
+
+    def save_index(self):
+        index = {
+            "obs_shape": self.obs_shape,
+            "obs_dtype": self.obs_dtype.str,
+            "num_actions": self.num_actions,
+            "segment_steps": self.segment_steps,
+            "next_segment": self.next_segment,
+            "head": self.head,
+            "segments": sorted(self.segments),
+            "first_id": self.first_id,
+            "first_step": self.episode_first_steps_[0] if self.episode_first_steps_ else self.next_step,
+            "episodes": list(zip(
+                self.episode_segments, self.episode_starts, self.episode_lengths_, self.episode_versions_
+            )),
+        }
+        # the new, empty log exists before the index that names it
+        old_name = self.log_name
+        generation = int(old_name[9:15]) + 1 if old_name else 0
+        index["log"] = self.log_name = "episodes-%06d.log" % generation
+        if self.log is not None:
+            self.log.close()
+        self.log = open(os.path.join(self.directory, self.log_name), "w")
+        self.logged = 0
+
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path) #never leave a half-written index behind
+        if old_name is not None and old_name != self.log_name:
+            try:
+                os.remove(os.path.join(self.directory, old_name))
+            except FileNotFoundError:
+                pass
+
+    def flush(self):
+        with self.lock:
+            for arrays in self.segments.values():
+                for array in arrays.values():
+                    if array.mode != "r":
+                        array.flush()
+            self.save_index()
+
+    def add_episode(self, obs, actions, rewards, dones, version=0):
+        size = len(obs)
+        assert size == len(actions) + 1, "episode needs one more observation than transitions"
+        assert size <= self.segment_steps, "episode does not fit in a segment"
+
+        with self.lock:
+            segments = (self.next_segment, self.first_id)
+            if self.head + size > self.segment_steps:
+                self.new_segment()
+
+            segment = self.next_segment - 1
+            arrays = self.segments[segment]
+            start = self.head
+            arrays["obs"][start:start+size] = obs
+            arrays["actions"][start:start+size-1] = actions
+            arrays["rewards"][start:start+size-1] = rewards
+            arrays["dones"][start:start+size-1] = dones
+
+            self.episode_segments.append(segment)
+            self.episode_starts.append(start)
+            self.episode_lengths_.append(size - 1)
+            self.episode_versions_.append(version)
+            self.episode_first_steps_.append(self.next_step)
+            self.next_step += size
+            self.head += size
+            self.steps += size - 1
+            self.collected += size - 1
+            self.added += 1
+
+            self.evict()
+            if (self.next_segment, self.first_id) != segments or self.logged >= self.index_interval:
+                self.save_index()
+            else:
+                self.log.write(json.dumps([segment, start, size - 1, version]) + "\n")
+                self.log.flush()
+                self.logged += 1
+            self.episode_added.notify_all()
+
+    def last_episode_reward(self):
+        with self.lock:
+            start, length = self.episode_starts[-1], self.episode_lengths_[-1]
+            return float(self.segments[self.episode_segments[-1]]["rewards"][start:start+length].sum())
+
+    def gather(self, episodes, offsets, seq_len, out=None):
+        """
+        Same as ReplayBuffer.gather, windows are read through the segment memmaps.
+        """
+        B = len(episodes)
+        if out is None:
+            out = (
+                np.empty((B, seq_len + 1, *self.obs_shape), dtype=self.obs_dtype),
+                np.empty((B, seq_len), dtype=np.int64),
+                np.empty((B, seq_len), dtype=np.float32),
+                np.empty((B, seq_len), dtype=np.bool_),
+            )
+
+        with self.lock:
+            segments = np.array(self.episode_segments, dtype=np.int64)[episodes]
+            starts = np.array(self.episode_starts, dtype=np.int64)[episodes] + offsets
+            slots = starts[:, None] + np.arange(seq_len + 1)
+
+            for segment in np.unique(segments): #one fancy-index per field and segment
+                rows = np.flatnonzero(segments == segment)
+                arrays = self.segments[segment]
+                out[0][rows] = arrays["obs"][slots[rows]]
+                out[1][rows] = arrays["actions"][slots[rows, :-1]]
+                out[2][rows] = arrays["rewards"][slots[rows, :-1]]
+                out[3][rows] = arrays["dones"][slots[rows, :-1]]
+
+        return out
+
+class EpisodeFollower(EpisodeStore):
+    """
+    Read-only view of an EpisodeStore written by another process, e.g. the shared
+    replay of a sweep. A background thread catches up with the writer every
+    interval seconds: it reads the new lines of the log and only rereads index.json
+    when the writer replaced it, maps new segments, drops evicted episodes and
+    appends new ones, with the same episode and step ids as the writer.
+    The writer logs an episode only after it is written, so every episode listed
+    is complete.
+    """
+    def __init__(self, directory, obs_shape, num_actions, obs_dtype=np.float32, interval=1.0):
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+        self.index_key = None #(inode, mtime, size) of the index last read
+        self.log_offset = 0 #bytes of the log read so far
+        self.log_id = 0 #id of the episode of the next log line
+        super(EpisodeFollower, self).__init__(directory, obs_shape, num_actions, obs_dtype=obs_dtype)
+
+    def load_index(self):
+        self.refresh()
+
+    def read_index(self):
+        """
+        Rereads index.json and applies it. Returns the number of new episodes, None
+        if it can not be read right now.
+        """
+        try:
+            stat = os.stat(self.index_path)
+            with open(self.index_path) as f:
+                index = json.load(f)
+            # map new segments first, the writer may evict one before it is opened
+            segments = {
+                segment: self.segments.get(segment) or {
+                    field: np.load(self.segment_path(segment, field), mmap_mode="r") for field in self.fields
+                }
+                for segment in index["segments"]
+            }
+        except FileNotFoundError: # nothing written yet, or replaced meanwhile
+            return None
+
+        self.obs_shape = tuple(index["obs_shape"])
+        self.obs_dtype = np.dtype(index["obs_dtype"])
+        self.num_actions = index["num_actions"]
+        self.segment_steps = index["segment_steps"]
+        self.segments = segments
+
+        first_id = index["first_id"]
+        if self.added < first_id: # evicted before they were seen, start over
+            for episodes in (self.episode_segments, self.episode_starts, self.episode_lengths_,
+                             self.episode_versions_, self.episode_first_steps_):
+                episodes.clear()
+            self.steps = 0
+            self.first_id = self.added = first_id
+            self.next_step = index["first_step"]
+
+        evicted = first_id - self.first_id
+        self.steps -= sum(self.episode_lengths_[:evicted])
+        for episodes in (self.episode_segments, self.episode_starts, self.episode_lengths_,
+                         self.episode_versions_, self.episode_first_steps_):
+            del episodes[:evicted]
+        self.first_id = first_id
+
+        new = index["episodes"][self.added - first_id:]
+        self.append_episodes(new)
+        self.collected += sum(length for _, _, length, _ in new)
+        self.index_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        self.log_name = index.get("log")
+        self.log_offset = 0
+        self.log_id = first_id + len(index["episodes"])
+        return len(new)
+
+    def refresh(self):
+        """
+        Catches up with the writer. Returns True if episodes were added.
+        """
+        with self.lock:
+            added = self.added
+            try:
+                stat = os.stat(self.index_path)
+            except FileNotFoundError:
+                return False
+            if (stat.st_ino, stat.st_mtime_ns, stat.st_size) != self.index_key:
+                if self.read_index() is None:
+                    return False
+
+            if self.log_name is not None:
+                episodes, self.log_offset = self.read_log(self.log_name, self.log_offset)
+                skip = max(self.added - self.log_id, 0) # already listed by the index
+                self.log_id += len(episodes)
+                self.append_episodes(episodes[skip:])
+                self.collected += sum(length for _, _, length, _ in episodes[skip:])
+
+            if self.added > added:
+                self.episode_added.notify_all()
+            return self.added > added
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.refresh()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def add_episode(self, *episode, version=0):
+        raise RuntimeError("%s is followed read-only" % self.directory)
+
+    def flush(self):
+        pass # the writer persists the store
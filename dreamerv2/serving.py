@@ -0,0 +1,200 @@
+import asyncio
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import numpy as np
+import torch
+
+from .model import sample_one_hot
+from .preprocess import Preprocessor
+
+class PolicyServer:
+    """
+    Serves actions to many concurrent sessions from one WorldModel and Actor.
+
+    The recurrent state (h, z and the previous action) of every session lives in one
+    row of a preallocated pool on the model device. Concurrent step() calls are
+    collected into a micro-batch until max_batch requests are waiting or the oldest
+    has waited max_delay seconds, then the batch runs forward_inference and the
+    actor once under inference_mode, on a worker thread so that new requests keep
+    queueing meanwhile. Like export.Policy, the server runs copies of the models set
+    to eval, so dropout is off; only the posterior sample and, unless greedy, the
+    action sample are random.
+
+    transform_obs turns a batch of raw observations into model inputs. By default it
+    is the Preprocessor for the model's observations: RAM bytes, or frames
+    downsampled to its frame size, gray if it takes one channel.
+
+    Usage, from inside a running event loop:
+        server = PolicyServer(world, actor)
+        server.start()
+        server.open_session("env-0")
+        action = await server.step("env-0", obs)
+        ...
+        await server.close()
+    """
+    def __init__(self, world, actor, max_sessions=256, max_batch=64, max_delay=2e-3,
+                 device="cpu", transform_obs=None, greedy=False):
+        self.world = copy.deepcopy(world)
+        for module in self.world.children(): # WorldModel.train is a training step, not nn.Module.train
+            module.eval()
+        self.actor = copy.deepcopy(actor).eval()
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.device = device
+        if transform_obs is None:
+            pixels = len(world.obs_shape) == 3
+            transform_obs = Preprocessor(
+                pixels=pixels, size=world.obs_shape[-1], gray=pixels and world.obs_shape[0] == 1
+            ).transform
+        self.transform_obs = transform_obs
+        self.greedy = greedy #argmax action instead of sampling
+
+        # slot pool
+        self.z = torch.zeros((max_sessions, 32*32), device=device)
+        self.h = torch.zeros((max_sessions, 512), device=device)
+        self.a = torch.zeros((max_sessions, world.num_action), device=device)
+        self.free_slots = list(range(max_sessions - 1, -1, -1))
+        self.sessions = {} #session id -> slot
+        self.fresh = set() #slots whose next step starts an episode
+
+        self.pending = [] #(slot, obs, future, arrival time) waiting for the next batch
+        self.busy = set() #slots with a request pending or in flight
+        self.wakeup = None
+        self.task = None
+        self.executor = ThreadPoolExecutor(max_workers=1) #the models run one batch at a time
+
+        self.requests = 0
+        self.batches = 0
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.serve())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        for _, _, future, _ in self.pending:
+            future.cancel()
+        self.pending = []
+        self.executor.shutdown()
+
+    def open_session(self, session_id):
+        """
+        Starts a session, its first step is treated as the first step of an episode.
+        """
+        if session_id in self.sessions:
+            raise ValueError("session %r is already open" % (session_id,))
+        if not self.free_slots:
+            raise RuntimeError("all %d session slots are in use" % len(self.z))
+        slot = self.free_slots.pop()
+        self.sessions[session_id] = slot
+        self.fresh.add(slot)
+
+    def reset_session(self, session_id):
+        # next step starts a new episode in the same slot
+        self.fresh.add(self.sessions[session_id])
+
+    def close_session(self, session_id):
+        slot = self.sessions.pop(session_id)
+        self.fresh.discard(slot)
+        self.free_slots.append(slot)
+
+    async def step(self, session_id, obs):
+        """
+        In:
+            obs: one raw observation as returned by the environment
+        Out:
+            action: int
+        """
+        slot = self.sessions[session_id]
+        if slot in self.busy:
+            raise RuntimeError("session %r already has a step in flight" % (session_id,))
+        self.busy.add(slot)
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((slot, obs, future, perf_counter()))
+        self.requests += 1
+        self.wakeup.set()
+        try:
+            return await future
+        finally:
+            self.busy.discard(slot)
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            if not self.pending:
+                continue
+
+            # wait for more requests until the batch is full or the oldest one is due
+            deadline = self.pending[0][3] + self.max_delay
+            while len(self.pending) < self.max_batch:
+                timeout = deadline - perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                self.wakeup.clear()
+
+            batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            if self.pending: # leftovers go straight into the next batch
+                self.wakeup.set()
+
+            slots = [slot for slot, _, _, _ in batch]
+            reset = np.array([slot in self.fresh for slot in slots])
+            self.fresh.difference_update(slots)
+            obs = np.stack([obs for _, obs, _, _ in batch])
+
+            try:
+                actions = await loop.run_in_executor(self.executor, self.run_batch, slots, obs, reset)
+            except Exception as e:
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches += 1
+            for (_, _, future, _), action in zip(batch, actions):
+                if not future.done(): # the client may have given up
+                    future.set_result(int(action))
+
+    def run_batch(self, slots, obs, reset):
+        """
+        In:
+            slots: [N] pool rows of the requesting sessions
+            obs:   [N, *obs_shape] raw observations
+            reset: [N] True for the first step of an episode
+        Out:
+            actions: [N] action indices
+        """
+        with torch.inference_mode():
+            index = torch.as_tensor(slots, device=self.device)
+            x = self.transform_obs(obs).to(self.device, non_blocking=True)
+            reset = torch.from_numpy(reset).to(self.device)
+
+            z_sample, h = self.world.forward_inference(
+                self.a[index], x, self.z[index], self.h[index], reset=reset
+            )
+            z_sample = z_sample.reshape(len(slots), 32*32)
+            logits = self.actor(z_sample)
+            if self.greedy:
+                a = torch.zeros_like(logits).scatter_(-1, logits.argmax(dim=-1, keepdim=True), 1.0)
+            else:
+                a = sample_one_hot(logits)
+
+            self.z.index_copy_(0, index, z_sample)
+            self.h.index_copy_(0, index, h)
+            self.a.index_copy_(0, index, a)
+
+            return a.argmax(dim=-1).cpu().numpy()
@@ -0,0 +1,339 @@
+import argparse
+from collections import deque
+from dataclasses import fields, replace
+from functools import partial
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+import torch
+
+from .checkpoint import CheckpointManager
+from .collector import SharedParameters, collector_process, drain_episodes, make_env, spawn_context
+from .config import Config
+from .metrics import make_sink
+from .model import WorldModel, Actor
+from .replay import EpisodeStore, EpisodeFollower
+from .train import Trainer, check_store, handle_sigterm, probe_env
+
+ACTOR_LOSS_FIELDS = ("actor_reinforce", "actor_dynamics", "actor_entropy") # order of ActorLoss(ns, nd, ne)
+
+class MemberScores:
+    """
+    Stand-in replay for the episodes of the collectors that follow one member:
+    forwards them to the shared store and keeps their returns. The returns are
+    sums of the stored, tanh-squashed rewards.
+    """
+    def __init__(self, store, window=10):
+        self.store = store
+        self.returns = deque(maxlen=window)
+
+    def add_episode(self, obs, actions, rewards, dones, version=0):
+        self.store.add_episode(obs, actions, rewards, dones, version=version)
+        self.returns.append(float(np.sum(rewards)))
+
+    def set_pending(self, name, episodes):
+        self.store.set_pending(name, episodes)
+
+    def score(self):
+        # mean return of the last window episodes, None until there are that many
+        returns = list(self.returns)
+        return float(np.mean(returns)) if len(returns) == self.returns.maxlen else None
+
+    def reset(self):
+        self.returns.clear()
+
+class SweepLearner(Trainer):
+    """
+    Trainer of one sweep member. It samples from the shared store through an
+    EpisodeFollower and publishes its models to params, which collectors of the
+    sweep follow, instead of running collectors of its own.
+    """
+    def __init__(self, config, params, replay_dir):
+        super(SweepLearner, self).__init__(config)
+        self.shared_params = params
+        self.replay_dir = replay_dir
+
+    def open_replay(self):
+        self.replay = EpisodeFollower(self.replay_dir, self.obs_shape, self.num_actions, obs_dtype=np.uint8)
+        self.replay.start()
+
+    def start_collection(self):
+        self.params = self.shared_params
+        while not self.params.publish({"world": self.world, "actor": self.actor}, self.iternum):
+            time.sleep(0.01) # a collector is reading the previous models
+
+    def close(self):
+        super(SweepLearner, self).close()
+        if self.replay is not None:
+            self.replay.stop()
+
+def member_process(config, params, replay_dir, num_threads=1):
+    torch.set_num_threads(num_threads)
+    SweepLearner(config, params, replay_dir).run()
+
+class Sweep:
+    """
+    Trains a population of configs, each the base config with a few fields
+    overridden, in their own learner processes. Episodes are collected once for
+    all of them: a common pool of collector processes writes into one EpisodeStore
+    that every learner reads. Collector i follows the models of member
+    i % population, so every member needs at least one collector to be scored.
+
+    Member i checkpoints to <save_dir>/member-<i> and writes its metrics there.
+
+    With pbt_interval > 0 (seconds) the members are ranked by the returns of the
+    episodes collected with their models. The bottom pbt_fraction continue from
+    the latest checkpoint of a random member of the top pbt_fraction (exploit),
+    with each overridden numeric field of that member multiplied by one of
+    perturb (explore). Every exploit is appended to <save_dir>/pbt.jsonl and the
+    current overrides to <save_dir>/sweep.json, from which a restarted sweep
+    resumes.
+    """
+    def __init__(self, config, members, pbt_interval=0, pbt_fraction=0.25, perturb=(0.8, 1.25), score_episodes=10):
+        self.config = config
+        self.members = members #overridden fields of each member
+        self.pbt_interval = pbt_interval
+        self.pbt_fraction = pbt_fraction
+        self.perturb = perturb
+        self.score_episodes = score_episodes
+
+        self.replay_dir = config.replay_dir or os.path.join(config.save_dir, "replay")
+        os.makedirs(config.save_dir, exist_ok=True)
+        if os.path.isfile(self.state_path):
+            with open(self.state_path) as f:
+                members = json.load(f)["members"]
+            if len(members) == len(self.members):
+                self.members = members
+        self.save_state()
+
+        self.store = None
+        self.params = []
+        self.scores = []
+        self.learners = []
+        self.queues = []
+        self.drains = []
+        self.collectors = []
+        self.running = None
+        self.stopped = None
+        self.log = None
+
+    @property
+    def state_path(self):
+        return os.path.join(self.config.save_dir, "sweep.json")
+
+    def save_state(self):
+        with open(self.state_path + ".tmp", "w") as f:
+            json.dump({"members": self.members}, f)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def member_dir(self, i):
+        return os.path.join(self.config.save_dir, "member-%d" % i)
+
+    def member_config(self, i):
+        metrics_name = os.path.basename(self.config.metrics_path or "metrics.jsonl")
+        return replace(
+            self.config, **self.members[i],
+            save_dir=self.member_dir(i), metrics_path=os.path.join(self.member_dir(i), metrics_name),
+            decoupled=True, persist_replay=False, replay_dir=None, world_size=1
+        )
+
+    def start(self):
+        c = self.config
+        preprocess, num_actions, obs_shape = probe_env(c)
+        self.store = EpisodeStore(self.replay_dir, obs_shape, num_actions, obs_dtype=np.uint8, max_bytes=c.replay_budget)
+        check_store(self.store, obs_shape)
+
+        # version -1 so the first models a learner publishes always differ
+        modules = {"world": WorldModel(c.gamma, num_actions, obs_shape=obs_shape, encoder=c.encoder), "actor": Actor(num_actions)}
+        population = len(self.members)
+        self.params = [SharedParameters(modules, version=-1) for _ in range(population)]
+        self.scores = [MemberScores(self.store, self.score_episodes) for _ in range(population)]
+        self.queues = [spawn_context.Queue() for _ in range(population)]
+        self.drains = [
+            threading.Thread(target=drain_episodes, args=(queue, scores), daemon=True)
+            for queue, scores in zip(self.queues, self.scores)
+        ]
+        for t in self.drains:
+            t.start()
+
+        self.running = spawn_context.Event()
+        self.running.set()
+        self.stopped = spawn_context.Event()
+        env_fn = partial(make_env, c.env_name, preprocess.pixels)
+        self.collectors = [
+            spawn_context.Process(
+                target=collector_process,
+                args=(self.params[i % population], self.queues[i % population], env_fn, c.num_envs, c.gamma, num_actions, preprocess),
+                kwargs={"obs_shape": obs_shape, "encoder": c.encoder, "name": str(i), "running": self.running, "stopped": self.stopped}
+            )
+            for i in range(c.num_collectors)
+        ]
+        for p in self.collectors:
+            p.start()
+
+        self.learners = [None] * population
+        for i in range(population):
+            self.start_member(i)
+        self.log = make_sink(os.path.join(c.save_dir, "pbt.jsonl"))
+
+    def start_member(self, i):
+        num_threads = max(1, (os.cpu_count() or 1) // len(self.members))
+        self.learners[i] = spawn_context.Process(
+            target=member_process, args=(self.member_config(i), self.params[i], self.replay_dir, num_threads)
+        )
+        self.learners[i].start()
+
+    def stop_member(self, i, timeout=60):
+        # SIGTERM, the learner writes a last checkpoint on the way out
+        p = self.learners[i]
+        p.terminate()
+        p.join(timeout)
+        if p.is_alive():
+            p.kill()
+            p.join()
+
+    def explore(self, overrides):
+        explored = {}
+        for k, v in overrides.items():
+            if isinstance(v, bool) or not isinstance(v, (int, float)):
+                explored[k] = v
+            elif isinstance(v, int):
+                explored[k] = max(1, int(round(v * random.choice(self.perturb))))
+            else:
+                explored[k] = v * random.choice(self.perturb)
+        return explored
+
+    def copy_checkpoint(self, src, i, scale):
+        """
+        Replaces the checkpoints of member i with src, the ActorLoss coefficients
+        multiplied by scale.
+        """
+        w = torch.load(src)
+        w["criterionActor"] = tuple(v * s for v, s in zip(w["criterionActor"], scale))
+        manager = CheckpointManager(self.member_dir(i))
+        for old in manager.checkpoints():
+            os.remove(old)
+        path = os.path.join(self.member_dir(i), os.path.basename(src))
+        torch.save(w, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def exploit_explore(self):
+        ranked = sorted((s.score(), i) for i, s in enumerate(self.scores) if s.score() is not None)
+        n = min(len(ranked) // 2, max(1, int(len(ranked) * self.pbt_fraction)))
+        if n == 0:
+            return
+        top = [i for _, i in ranked[-n:]]
+        for score, i in ranked[:n]:
+            donor = random.choice(top)
+            src = CheckpointManager(self.member_dir(donor)).latest()
+            if src is None: # no checkpoint yet
+                continue
+
+            overrides = self.explore(self.members[donor])
+            donor_config, config = self.member_config(donor), replace(self.config, **overrides)
+            scale = [
+                getattr(config, k) / getattr(donor_config, k) if getattr(donor_config, k) else 1.0
+                for k in ACTOR_LOSS_FIELDS
+            ]
+
+            self.stop_member(i)
+            self.copy_checkpoint(src, i, scale)
+            self.members[i] = overrides
+            self.save_state()
+            self.scores[i].reset()
+            self.start_member(i)
+            self.log.write({
+                "time": time.time(), "member": i, "score": score, "donor": donor,
+                "donor_score": self.scores[donor].score(), "overrides": overrides,
+            })
+
+    def run(self):
+        handle_sigterm()
+        self.start()
+        last = time.time()
+        try:
+            while True:
+                time.sleep(1)
+                for i, p in enumerate(self.learners):
+                    if not p.is_alive():
+                        raise RuntimeError("member %d exited with code %s" % (i, p.exitcode))
+                if self.pbt_interval > 0 and time.time() - last > self.pbt_interval:
+                    last = time.time()
+                    self.exploit_explore()
+        finally:
+            self.close()
+
+    def close(self, timeout=30):
+        for i, p in enumerate(self.learners):
+            if p is not None and p.is_alive():
+                self.stop_member(i)
+
+        # collectors add their unfinished episodes to the store on the way out
+        if self.stopped is not None:
+            self.stopped.set()
+            self.running.set()
+        for p in self.collectors:
+            p.join(timeout)
+            if p.is_alive():
+                p.terminate()
+        for queue in self.queues:
+            queue.put(None)
+        for t in self.drains:
+            t.join(timeout)
+        if self.store is not None:
+            self.store.flush()
+        if self.log is not None:
+            self.log.close()
+
+def parse_value(field, value):
+    if field.type is bool:
+        return value.lower() in ("1", "true", "yes")
+    return (str if field.type is Optional[str] else field.type)(value)
+
+def grid_members(grid, population=0):
+    """
+    Overrides of every combination of the grid values, repeated up to population.
+    In:
+        grid: ["lr_world=1e-4,3e-4", "H=10,15"]
+    """
+    config_fields = {f.name: f for f in fields(Config)}
+    names, values = [], []
+    for spec in grid:
+        name, _, choices = spec.partition("=")
+        if name not in config_fields:
+            raise ValueError("unknown config field %r" % name)
+        names.append(name)
+        values.append([parse_value(config_fields[name], v) for v in choices.split(",")])
+
+    members = [dict(zip(names, combination)) for combination in itertools.product(*values)]
+    population = population or len(members)
+    return [dict(members[i % len(members)]) for i in range(population)]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="dreamerv2.sweep", description="Train a population of configs on one shared replay",
+        epilog="Every other option is a dreamerv2 option shared by all members."
+    )
+    parser.add_argument("--grid", action="append", default=[], metavar="FIELD=V1,V2,...",
+                        help="values of one config field, members cover every combination")
+    parser.add_argument("--population", type=int, default=0, help="members, cycling through the combinations (default: one each)")
+    parser.add_argument("--pbt_interval", type=float, default=0, help="seconds between exploit/explore rounds, 0 disables them")
+    parser.add_argument("--pbt_fraction", type=float, default=0.25, help="fraction of members replaced, and copied from, per round")
+    parser.add_argument("--score_episodes", type=int, default=10, help="episodes a member is scored over")
+    args, rest = parser.parse_known_args(argv)
+
+    config = Config.from_args(rest)
+    members = grid_members(args.grid, args.population)
+    Sweep(
+        config, members, pbt_interval=args.pbt_interval, pbt_fraction=args.pbt_fraction, score_episodes=args.score_episodes
+    ).run()
+
+# learner and collector processes are spawned and import the main module again
+if __name__ == "__main__":
+    main()
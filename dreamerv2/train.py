@@ -1,317 +1,600 @@
-from concurrent.futures import ThreadPoolExecutor
-import gym
-import matplotlib.pyplot as plt
-from math import tanh
-import numpy as np
+from functools import partial
 import os
-import PIL
+import resource
+import signal
+import sys
 import threading
-from time import sleep, time
+from time import time
+
+import numpy as np
 from tqdm import tqdm
 import torch
 from torch.optim import Adam
-import torchvision
-
-from dataset import ModelDataset
-from model import WorldModel, Actor, Critic, LossModel, ActorLoss, CriticLoss
-
-### HYPERPARAMETERS ### 
-save_path = "save.chkpt"
-env_name = "BreakoutNoFrameskip-v4"
-env = gym.make(env_name, obs_type="ram", full_action_space=True)
-# env = gym.make(env_name, frameskip = 4)
-num_actions = env.action_space.n
-
-batch = 64
-L = 50 # seq len world training
-history_size = 64
-lr_world = 2e-4
-
-H = 15 # imagination length
-gamma = 0.995 # discount factor
-lamb = 0.95 # lambda-target
-lr_actor = 4e-5
-lr_critic = 1e-4
-target_interval = 100 # update interval for target critic
-
-gradient_clipping = 100
-adam_eps = 1e-5
-decay = 1e-6
-
-###  MODELS ###
-if torch.cuda.is_available():
-    world = WorldModel(gamma, num_actions).cuda()
-    actor = Actor(num_actions).cuda()
-    critic = Critic().cuda()
-    target = Critic().cuda()
-else:
-    world = WorldModel(gamma, num_actions)
-    actor = Actor(num_actions)
-    critic = Critic()
-    target = Critic()
-
-criterionModel = LossModel()
-criterionActor = ActorLoss()
-criterionCritic = CriticLoss()
-
-optim_model = Adam(world.parameters(), lr=lr_world, eps=adam_eps, weight_decay=decay)
-optim_actor = Adam(actor.parameters(), lr=lr_actor, eps=adam_eps, weight_decay=decay)
-optim_critic = Adam(critic.parameters(), lr=lr_critic, eps=adam_eps, weight_decay=decay)
-optim_target = Adam(target.parameters())
-
-if os.path.isfile(save_path):
-    w = torch.load(save_path)
-    try:
-        world.load_state_dict(w["world"])
-        optim_model.load_state_dict(w["optim_model"])
-        actor.load_state_dict(w["actor"])
-        optim_actor.load_state_dict(w["optim_actor"])
-        critic.load_state_dict(w["critic"])
-        optim_critic.load_state_dict(w["optim_critic"])
-        criterionActor = ActorLoss(*w["criterionActor"])
-    except:
-        print ("error loading model")
-        
-        if torch.cuda.is_available():
-            world = WorldModel(gamma, num_actions).cuda()
-            actor = Actor(num_actions).cuda()
-            critic = Critic().cuda()
-            target = Critic().cuda()
-        else:
-            world = WorldModel(gamma, num_actions)
-            actor = Actor(num_actions)
-            critic = Critic()
-            target = Critic()
-            
-        criterionModel = LossModel()
-        criterionActor = ActorLoss()
-        criterionCritic = CriticLoss()
-        optim_model = Adam(world.parameters(), lr=lr_world, eps=adam_eps, weight_decay=decay)
-        optim_actor = Adam(actor.parameters(), lr=lr_actor, eps=adam_eps, weight_decay=decay)
-        optim_critic = Adam(critic.parameters(), lr=lr_critic, eps=adam_eps, weight_decay=decay)
-        optim_target = Adam(target.parameters())
-    del w
-    
-with torch.no_grad():
-    target.load_state_dict(critic.state_dict())
-
-### MISC ###
-#  resize = torchvision.transforms.Resize(
-#      (64,64),
-#      interpolation=PIL.Image.BICUBIC
-#  )
-#  grayscale = torchvision.transforms.Grayscale()
-def transform_obs(obs):
-    #  obs = resize(torch.from_numpy(obs.transpose(2,0,1))) #  3, 64, 64
-    obs = torch.from_numpy(obs)
-    return (obs.float() - 255/2).unsqueeze(0)
-
-history = []
-tensor_range = torch.arange(0, num_actions).unsqueeze(0)
-random_action_dist = torch.distributions.one_hot_categorical.OneHotCategorical(torch.ones((1, num_actions)))
-
-def gather_episode():
-    print ("Gathering data")
-    with torch.no_grad():
-        while True:
-            obs = env.reset()
-            obs = transform_obs(obs)
-            episode = [obs]
-            if (torch.cuda.is_available()):
-                obs = obs.cuda()
-
-            z_sample, h = world(None, obs, None, inference=True)
-            done = False
-            
-            while not done:
-                #  env.render()
-                a = actor(z_sample)
-                a = torch.distributions.one_hot_categorical.OneHotCategorical(logits = a).sample()
-                obs, rew, done, _ = env.step(int((a.cpu()*tensor_range).sum().round())) #  take a random action (int)
-                obs = transform_obs(obs)
-                
-                if (torch.cuda.is_available()):
-                    obs = obs.cuda()
-                
-                episode.extend([a.cpu(), tanh(rew), done, obs.cpu()])
-                
-                if not done:
-                    z_sample, h = world(a, obs, z_sample.reshape(-1, 1024), h, inference=True)
-                
-                #  plt.imshow(obs[0].cpu().numpy().transpose(1,2,0)/2+0.5)
-                #  plt.show()
-            history.append(episode)
-            for _ in range(len(history) - history_size):
-                history.pop(0)
-
-# start gathering episode thread
-t = threading.Thread(target=gather_episode)
-t.start()
-
-print ("Dataset init")
-while len(history) < 1:
-    pass
-print ("done")
-
-def act_straight_through(z_hat_sample):
-    a_logits = actor(z_hat_sample)
-    a_sample = torch.distributions.one_hot_categorical.OneHotCategorical(
-        logits=a_logits
-    ).sample()
-    a_probs = torch.softmax(a_logits, dim=-1)
-    a_sample = a_sample + a_probs - a_probs.detach()
-
-    return a_sample, a_logits
-
-### DATASET ###
-ds = ModelDataset(history, seq_len=L, gamma=gamma, history_size=history_size)
-loader = torch.utils.data.DataLoader(
-    ds,
-    batch_size=batch,
-    shuffle=True,
-    num_workers=0,
-    drop_last=False,
-    pin_memory=True
-)
-
-iternum = 0
-start = time()
-
-while True:
-    pbar = tqdm(loader)
-    for s, a, r, g in pbar:
-        if (torch.cuda.is_available()):
-            s = s.cuda()
-            a = a.cuda()
-            r = r.cuda()
-            g = g.cuda()
-            
-        z_list = []
-        h_list = []
-
-        # # #  Train world model # # # 
-        z_logit, z_sample, z_hat_logits, x_hat, r_hat, gamma_hat, h, _ = world(a=None, x=s[:,0], z=None, h=None)
-        loss_model = criterionModel(s[:,0], r[:,0], g[:,0], z_logit, z_sample, x_hat, 0, gamma_hat, z_hat_logits)
-        z_list.append(z_sample.detach())
-        h_list.append(h.detach())
-        
-        for t in range(L):
-            z_logit, z_sample, z_hat_logits, x_hat, r_hat, gamma_hat, h, _ = world(a[:,t], s[:,t+1], z_sample, h)
-            z_list.append(z_sample.detach())
-            h_list.append(h.detach())
-            loss_model += criterionModel(s[:,t+1], r[:,t], g[:,t], z_logit, z_sample, x_hat, r_hat, gamma_hat, z_hat_logits)
-        
-        loss_model /= L
-        loss_model.backward()
-        torch.nn.utils.clip_grad_norm_(world.parameters(), gradient_clipping)
-        optim_model.step()
-        optim_model.zero_grad()
-
-        # # #  Train actor critic # # # 
-        # store every value to compute V since we sum backwards
-        r_hat_sample_list = []
-        gamma_hat_sample_list = []
-        a_sample_list = []
-        a_logits_list = []
-
-        z_hat_sample = torch.cat(z_list, dim=0).detach() # convert all z to z0, squash time dim
-        z_hat_sample_list = [z_hat_sample]
-
-        h = torch.cat(h_list, dim=0).detach() # get corresponding h0
-        
-        #  store values
-        for _ in range(H):
-            a_sample, a_logits = act_straight_through(z_hat_sample)
-
-            *_, h, (z_hat_sample, r_hat_sample, gamma_hat_sample) = world(a_sample, x = None, z = z_hat_sample.reshape(-1, 1024), h = h, dream=True)
-            r_hat_sample_list.append(r_hat_sample)
-            gamma_hat_sample_list.append(gamma_hat_sample)
-            z_hat_sample_list.append(z_hat_sample)
-            a_sample_list.append(a_sample)
-            a_logits_list.append(a_logits)
-
-        #  calculate paper recursion by looping backward 
-        V = r_hat_sample_list[-1] + gamma_hat_sample_list[-1] * target(z_hat_sample_list[-1]) # V_H-1
-        ve = critic(z_hat_sample_list[-2].detach())
-        loss_critic = criterionCritic(V.detach(), ve)
-        loss_actor = criterionActor(
-            a_sample_list[-1],
-            torch.distributions.one_hot_categorical.OneHotCategorical(logits=a_logits_list[-1]),
-            V, ve.detach()
+
+from .checkpoint import CheckpointManager
+from .collector import SubprocVecEnv, VectorCollector, SharedParameters, collector_process, drain_episodes, make_env, spawn_context
+from .dataset import SequenceSampler
+from .latents import LatentCache, LatentRefresher
+from .distributed import all_reduce_gradients, broadcast_modules, broadcast_int
+from .metrics import Metrics, ProfilerWindow, make_sink
+from .prefetch import Prefetcher
+from .priority import PrioritizedSampler
+from .replay import ReplayBuffer, EpisodeStore
+from .preprocess import Preprocessor
+from .model import WorldModel, Actor, Critic, LossModel, ActorLoss, CriticLoss, autocast, lambda_returns
+
+def probe_env(config):
+    """
+    Out:
+        preprocess:  Preprocessor for the observations of config
+        num_actions: actions of the environment
+        obs_shape:   shape of one observation as stored in the replay
+    """
+    preprocess = Preprocessor(pixels=config.obs_type == "pixels", size=config.frame_size, gray=config.grayscale)
+    env = make_env(config.env_name, preprocess.pixels) # only used for the spaces
+    num_actions = env.action_space.n
+    obs_shape = preprocess.obs_shape(env.observation_space.shape)
+    env.close()
+    return preprocess, num_actions, obs_shape
+
+def check_store(store, obs_shape):
+    # an EpisodeStore reopened from disk may hold the observations of another config
+    if store.obs_dtype != np.uint8 or store.obs_shape != obs_shape:
+        raise ValueError("%s holds %s observations of shape %s, expected uint8 %s" % (
+            store.directory, store.obs_dtype, store.obs_shape, obs_shape))
+
+def handle_sigterm():
+    # preemption: shut down like on Ctrl-C, only possible from the main thread
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+def peak_memory_mb():
+    # peak of the current iteration on GPU, peak resident size of the process on CPU
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated() / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+class Trainer:
+    """
+    Trains DreamerV2 as set up by a Config. Nothing is built on construction: models,
+    replay and collectors are created when first needed, at the latest by run().
+
+    With world_size > 1 every rank runs one Trainer in an initialized gloo process
+    group. Each rank collects into its own replay, so batches are disjoint, gradients
+    are averaged before every optimizer step and rank 0 writes the checkpoints.
+    """
+    def __init__(self, config, rank=0, world_size=1):
+        self.config = config
+        self.rank = rank
+        self.world_size = world_size
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.iternum = 0
+
+        self.world = None
+        self.replay = None
+        self.sampler = None
+        self.prefetcher = None
+        self.latents = None
+        self.refresher = None
+        self.world_lock = threading.Lock() #held around world-model optimizer steps, see LatentRefresher
+        self.collectors = []
+        self.envs = None
+        self.collector = None
+        self.params = None
+        self.episode_queue = None
+        self.drain = None
+        self.collecting = None #cleared to pause the collector processes
+        self.collection_stopped = None
+        self.manager = CheckpointManager(
+            config.save_dir, keep=config.keep_checkpoints, replay_name="replay" if rank == 0 else "replay-rank%d" % rank
         )
-        
-        for t in range(H-2, -1, -1):
-            V = r_hat_sample_list[t] + gamma_hat_sample_list[t] * ((1-lamb)*target(z_hat_sample_list[t+1]) + lamb*V)
-            ve = critic(z_hat_sample_list[t].detach())
-            loss_critic += criterionCritic(V.detach(), ve)
-            loss_actor += criterionActor(
-                a_sample_list[t],
-                torch.distributions.one_hot_categorical.OneHotCategorical(logits=a_logits_list[t]),
-                V, ve.detach()
+        self.metrics = Metrics(synchronize=config.sync_timing)
+        self.profiler = None
+
+    def build(self):
+        c = self.config
+        if c.precision == "fp16" and self.device != "cuda":
+            raise ValueError("precision fp16 needs a GPU for loss scaling, use bf16 on CPU")
+        self.preprocess, self.num_actions, self.obs_shape = probe_env(c)
+
+        ###  MODELS ###
+        self.world = WorldModel(c.gamma, self.num_actions, obs_shape=self.obs_shape, encoder=c.encoder).to(self.device)
+        self.actor = Actor(self.num_actions).to(self.device)
+        self.critic = Critic().to(self.device)
+        self.target = Critic().to(self.device)
+
+        self.criterionModel = LossModel()
+        self.criterionActor = ActorLoss(c.actor_reinforce, c.actor_dynamics, c.actor_entropy)
+        self.criterionCritic = CriticLoss()
+
+        self.optim_model = Adam(self.world.parameters(), lr=c.lr_world, eps=c.adam_eps, weight_decay=c.decay)
+        self.optim_actor = Adam(self.actor.parameters(), lr=c.lr_actor, eps=c.adam_eps, weight_decay=c.decay)
+        self.optim_critic = Adam(self.critic.parameters(), lr=c.lr_critic, eps=c.adam_eps, weight_decay=c.decay)
+        self.optim_target = Adam(self.target.parameters())
+
+        # dream rollout, optionally compiled
+        self.imagine = self.world.imagine_compact if c.compact_latents else self.world.imagine
+        if c.compile_imagination:
+            self.imagine = torch.compile(self.imagine)
+
+        # loss scaling is only needed for fp16
+        self.scaler = torch.amp.GradScaler(self.device, enabled=c.precision == "fp16")
+
+    def load(self):
+        """
+        Resumes from the latest checkpoint if there is one, starts from scratch if there is none.
+        """
+        self.load_checkpoint()
+        if self.world_size > 1: # every rank starts from the models of rank 0
+            broadcast_modules([self.world, self.actor, self.critic, self.target])
+            self.iternum = broadcast_int(self.iternum)
+
+    def load_checkpoint(self):
+        # a checkpoint that can not be loaded is an error, training from scratch would prune it
+        self.build()
+        path = self.manager.latest()
+        if path is not None:
+            try:
+                w = torch.load(path)
+            except Exception as e:
+                raise ValueError("could not load %s: %s" % (path, e)) from e
+
+            world_config = {"obs_shape": list(self.obs_shape), "encoder": self.config.encoder}
+            saved = w.get("world_config")
+            if saved is not None and saved != world_config:
+                raise ValueError("%s was saved with %s, the config gives %s" % (path, saved, world_config))
+            try:
+                self.world.load_state_dict(w["world"])
+                self.optim_model.load_state_dict(w["optim_model"])
+                self.actor.load_state_dict(w["actor"])
+                self.optim_actor.load_state_dict(w["optim_actor"])
+                self.critic.load_state_dict(w["critic"])
+                self.optim_critic.load_state_dict(w["optim_critic"])
+                self.criterionActor = ActorLoss(*w["criterionActor"])
+                self.target.load_state_dict(w["target"])
+                self.iternum = w["iternum"]
+            except Exception as e:
+                raise ValueError("could not load %s: %s" % (path, e)) from e
+            # learning rates come from the config, e.g. changed by a sweep
+            for optim, lr in ((self.optim_model, self.config.lr_world), (self.optim_actor, self.config.lr_actor),
+                              (self.optim_critic, self.config.lr_critic)):
+                for group in optim.param_groups:
+                    group["lr"] = lr
+            return
+
+        with torch.no_grad():
+            self.target.load_state_dict(self.critic.state_dict())
+
+    def open_replay(self):
+        # replay of this rank, refilled from disk when configured
+        c = self.config
+        if c.replay_dir is None:
+            self.replay = ReplayBuffer(c.replay_capacity, self.obs_shape, self.num_actions, obs_dtype=np.uint8)
+            if c.persist_replay:
+                self.manager.restore_replay(self.replay)
+                self.manager.restore_pending(self.replay)
+        else: # keeps episodes of previous runs
+            replay_dir = c.replay_dir if self.rank == 0 else os.path.join(c.replay_dir, "rank-%d" % self.rank)
+            self.replay = EpisodeStore(replay_dir, self.obs_shape, self.num_actions, obs_dtype=np.uint8, max_bytes=c.replay_budget)
+            check_store(self.replay, self.obs_shape)
+            if c.persist_replay:
+                self.manager.restore_pending(self.replay)
+
+    def build_replay(self):
+        c = self.config
+        self.open_replay()
+        if c.latent_cache:
+            self.latents = LatentCache(c.latent_cache)
+
+        ### DATASET ###
+        if c.sampling == "episodes":
+            self.sampler = SequenceSampler(self.replay, batch_size=c.batch, seq_len=c.L, gamma=c.gamma, pin_memory=torch.cuda.is_available())
+        else:
+            self.sampler = PrioritizedSampler(
+                self.replay, batch_size=c.batch, seq_len=c.L, gamma=c.gamma, mode=c.sampling,
+                capacity=c.replay_capacity, alpha=c.priority_alpha, half_life=c.recency_half_life,
+                pin_memory=torch.cuda.is_available()
             )
 
-        loss_actor /= (H-1)
-        loss_critic /= (H-1)
-
-        # update actor
-        loss_actor.backward()
-        loss_critic.backward()
-        torch.nn.utils.clip_grad_norm_(actor.parameters(), gradient_clipping)
-        optim_actor.step()
-        optim_actor.zero_grad()
-        optim_model.zero_grad()
-
-        # update critic
-        torch.nn.utils.clip_grad_norm_(critic.parameters(), gradient_clipping)
-        optim_critic.step()
-        optim_critic.zero_grad()
-        optim_target.zero_grad()
-
-        # update target network with critic weights
-        iternum += 1
-        if not iternum % target_interval:
-            with torch.no_grad():
-                target.load_state_dict(critic.state_dict())
-        
-        #  display
-        pbar.set_postfix(
-            l_world = loss_model.item(),
-            l_actor = loss_actor.item(),
-            l_critic = loss_critic.item(),
-            len_h = len(history),
-            iternum=iternum,
-            last_rew=sum(history[-1][2::4]),
+    def start_collection(self):
+        # start collecting episodes, envs are stepped in subprocesses
+        c = self.config
+        env_fn = partial(make_env, c.env_name, self.preprocess.pixels)
+        if c.decoupled:
+            self.params = SharedParameters({"world": self.world, "actor": self.actor}, version=self.iternum)
+            self.episode_queue = spawn_context.Queue()
+            self.collecting = spawn_context.Event()
+            self.collecting.set()
+            self.collection_stopped = spawn_context.Event()
+            self.collectors = [
+                spawn_context.Process(
+                    target=collector_process,
+                    args=(self.params, self.episode_queue, env_fn, c.num_envs, c.gamma, self.num_actions, self.preprocess),
+                    kwargs={
+                        "obs_shape": self.obs_shape, "encoder": c.encoder, "name": str(i),
+                        "flush_interval": c.flush_interval, "running": self.collecting, "stopped": self.collection_stopped,
+                    }
+                )
+                for i in range(c.num_collectors)
+            ]
+            for p in self.collectors:
+                p.start()
+            self.drain = threading.Thread(target=drain_episodes, args=(self.episode_queue, self.replay), daemon=True)
+            self.drain.start()
+        else:
+            self.envs = SubprocVecEnv([env_fn for _ in range(c.num_envs)])
+            self.collector = VectorCollector(
+                self.envs, self.world, self.actor, self.replay, self.preprocess, self.device,
+                flush_interval=c.flush_interval
+            )
+            self.collector.version = self.iternum
+            self.collector.start()
+
+    def pause_collection(self):
+        # collectors hold between two env steps until resume_collection
+        if self.collector is not None:
+            self.collector.pause()
+        if self.collecting is not None:
+            self.collecting.clear()
+
+    def resume_collection(self):
+        if self.collector is not None:
+            self.collector.resume()
+        if self.collecting is not None:
+            self.collecting.set()
+
+    def stop_collection(self, timeout=30):
+        """
+        Stops the collectors and waits until the episodes in progress reached the
+        replay as truncated episodes. Collector processes still running after
+        timeout seconds are terminated.
+        """
+        if self.collector is not None:
+            self.collector.stop(timeout)
+            self.collector = None
+        if self.envs is not None:
+            self.envs.close()
+            self.envs = None
+
+        if self.collectors:
+            self.collection_stopped.set()
+            self.collecting.set() # wake up paused ones
+            for p in self.collectors:
+                p.join(timeout)
+                if p.is_alive():
+                    p.terminate()
+            self.collectors = []
+        if self.drain is not None:
+            self.episode_queue.put(None) # after everything the collectors sent
+            self.drain.join(timeout)
+            self.drain = None
+
+    def world_model_loss(self, s, r, g, out, t0):
+        """
+        Loss of the observed steps t0, t0+1, ... of the batch. Step t predicts the reward
+        and discount of transition t-1, so step 0 has no reward or discount term.
+        Out:
+            loss:  differentiable scalar
+            terms: detached loss terms
+        """
+        z_logits, z_sample, z_hat_logits, x_hat, r_hat, gamma_hat, _ = out
+        T = z_logits.shape[1]
+        j0 = 1 if t0 == 0 else 0
+        return self.criterionModel(
+            s[:, t0:t0+T], r[:, t0+j0-1:t0+T-1], g[:, t0+j0-1:t0+T-1],
+            z_logits, z_sample, x_hat, r_hat[:, j0:], gamma_hat[:, j0:], z_hat_logits
         )
-        
-        print (a_logits_list[0][0].detach())
-        print (list(z_hat_sample_list[-1][0,1].detach().cpu().numpy().round()).index(1))
 
-    # save once in a while
-    if time() - start > 1*60:
-        start = time()
-        print ("Saving...")
-        
-        torch.save(
+    def sequence_losses(self, r, out, t0):
+        """
+        Detached per-sequence world-model error of the observed steps t0, t0+1, ...,
+        KL(posterior || prior) plus squared reward error, used as sampling priority.
+        Out:
+            losses: [B]
+        """
+        z_logits, _, z_hat_logits, _, r_hat, _, _ = out
+        B, T = z_logits.shape[:2]
+        log_q = torch.log_softmax(z_logits.detach().float().reshape(B, T, 32, 32), dim=-1)
+        log_p = torch.log_softmax(z_hat_logits.detach().float().reshape(B, T, 32, 32), dim=-1)
+        losses = (log_q.exp() * (log_q - log_p)).sum(dim=(1, 2, 3))
+
+        # step 0 has no reward prediction
+        j0 = 1 if t0 == 0 else 0
+        r_hat = r_hat[:, j0:].detach().float()
+        losses += ((r_hat - r[:, t0+j0-1:t0+j0-1+r_hat.shape[1]])**2).sum(dim=(1, 2))
+        return losses
+
+    def train_world_model(self, s, a, r, g, info=None):
+        """
+        One world-model update on a batch of sequences.
+        info: what the sampler returned about the batch, the last batch of sample if None
+        Out:
+            z_sample:   [B, L+1, 1024] posterior samples, detached
+            h:          [B, L+1, 512] GRU states, detached
+            loss_model: float
+            loss_terms: dict of the detached terms of loss_model
+        """
+        c = self.config
+        L = c.L
+
+        # tbptt backpropagates chunk by chunk and carries (z, h) over without gradient
+        chunk = c.tbptt_chunk if c.memory_mode == "tbptt" else L+1
+        z_sample, h = None, None
+        z_chunks, h_chunks = [], []
+        loss_model = 0
+        loss_terms = {}
+        priorities = c.sampling == "loss"
+        seq_losses = 0
+
+        for t0 in range(0, L+1, chunk):
+            with self.metrics.phase("world_forward"):
+                with autocast(self.device, c.precision):
+                    out = self.world.observe(
+                        s[:, t0:t0+chunk], a[:, max(t0-1, 0):t0+chunk-1], z_sample, h,
+                        checkpoint=c.memory_mode == "checkpoint"
+                    )
+                loss_chunk, terms = self.world_model_loss(s, r, g, out, t0)
+                loss_chunk = loss_chunk / L
+            with self.metrics.phase("world_backward"):
+                self.scaler.scale(loss_chunk).backward()
+            loss_model += loss_chunk.detach() # synced once per batch below
+            for k, v in terms.items():
+                loss_terms[k] = loss_terms.get(k, 0) + v / L
+            if priorities:
+                seq_losses += self.sequence_losses(r, out, t0)
+
+            z_sample, h = out[1][:, -1].detach(), out[6][:, -1].detach()
+            z_chunks.append(out[1].detach())
+            h_chunks.append(out[6].detach())
+            del out, loss_chunk
+
+        if self.world_size > 1:
+            with self.metrics.phase("all_reduce"):
+                all_reduce_gradients(self.world.parameters())
+
+        with self.metrics.phase("world_optim"):
+            self.scaler.unscale_(self.optim_model)
+            torch.nn.utils.clip_grad_norm_(self.world.parameters(), c.gradient_clipping)
+            with self.world_lock:
+                self.scaler.step(self.optim_model)
+            self.optim_model.zero_grad()
+
+        if priorities:
+            self.sampler.update_priorities(seq_losses.cpu().numpy(), info)
+
+        return torch.cat(z_chunks, dim=1), torch.cat(h_chunks, dim=1), float(loss_model), loss_terms
+
+    def train_actor_critic(self, z_sample, h):
+        """
+        One actor and critic update, dreaming from every posterior of the world-model pass.
+        Out:
+            loss_actor, loss_critic: floats
+        """
+        c = self.config
+        H = c.H
+
+        # storing every value to compute V since we sum backwards
+        z_hat_sample = z_sample.reshape(-1, 32, 32).detach() # convert all z to z0, squash time dim
+        h = h.reshape(-1, 512).detach() # get corresponding h0
+
+        N = h.shape[0]
+        with self.metrics.phase("imagine"), autocast(self.device, c.precision):
+            if c.compact_latents:
+                z_index, z_probs, _, a_samples, a_logits_seq, r_hat_samples, gamma_hat_samples = self.imagine(self.actor, z_hat_sample, h, H)
+            else:
+                z_hat_samples, _, a_samples, a_logits_seq, r_hat_samples, gamma_hat_samples = self.imagine(self.actor, z_hat_sample, h, H)
+
+        with self.metrics.phase("returns"):
+            # target and critic evaluated once over all steps
+            with autocast(self.device, c.precision):
+                if c.compact_latents:
+                    values = self.target(z_index[1:].reshape(H*N, 32), z_probs.reshape(H*N, 32, 32)).reshape(H, N, 1).float()
+                    ve = self.critic(z_index[:-1].reshape(H*N, 32)).reshape(H, N, 1).float()
+                else:
+                    values = self.target(z_hat_samples[1:].reshape(H*N, -1)).reshape(H, N, 1).float()
+                    ve = self.critic(z_hat_samples[:-1].detach().reshape(H*N, -1)).reshape(H, N, 1).float()
+
+            #  calculate paper recursion
+            V = lambda_returns(r_hat_samples, gamma_hat_samples, values, values[-1], c.lamb)
+
+            loss_critic = self.criterionCritic(V.detach(), ve)
+            loss_actor = self.criterionActor(a_samples, a_logits_seq, V, ve.detach())
+
+        with self.metrics.phase("actor_critic_backward"):
+            self.scaler.scale(loss_actor).backward()
+            self.scaler.scale(loss_critic).backward()
+
+        if self.world_size > 1:
+            with self.metrics.phase("all_reduce"):
+                all_reduce_gradients(list(self.actor.parameters()) + list(self.critic.parameters()))
+
+        with self.metrics.phase("actor_critic_optim"):
+            # update actor
+            self.scaler.unscale_(self.optim_actor)
+            torch.nn.utils.clip_grad_norm_(self.actor.parameters(), c.gradient_clipping)
+            self.scaler.step(self.optim_actor)
+            self.optim_actor.zero_grad()
+            self.optim_model.zero_grad()
+
+            # update critic
+            self.scaler.unscale_(self.optim_critic)
+            torch.nn.utils.clip_grad_norm_(self.critic.parameters(), c.gradient_clipping)
+            self.scaler.step(self.optim_critic)
+            self.optim_critic.zero_grad()
+            self.optim_target.zero_grad()
+            self.scaler.update()
+
+        return loss_actor.item(), loss_critic.item()
+
+    def save(self):
+        replay = self.replay if self.config.persist_replay else None
+        if self.rank != 0: # only the replay shard of this rank
+            if replay is not None:
+                self.manager.save(None, self.iternum, replay)
+            return
+
+        print ("Saving...") # written in the background
+        self.manager.save(
             {
-                "world": world.state_dict(),
-                "actor": actor.state_dict(),
-                "critic": critic.state_dict(),
-                "optim_model": optim_model.state_dict(),
-                "optim_actor": optim_actor.state_dict(),
-                "optim_critic": optim_critic.state_dict(),
-                "criterionActor": (criterionActor.ns, criterionActor.nd, criterionActor.ne),
+                "world": self.world.state_dict(),
+                "actor": self.actor.state_dict(),
+                "critic": self.critic.state_dict(),
+                "target": self.target.state_dict(),
+                "optim_model": self.optim_model.state_dict(),
+                "optim_actor": self.optim_actor.state_dict(),
+                "optim_critic": self.optim_critic.state_dict(),
+                "criterionActor": (self.criterionActor.ns, self.criterionActor.nd, self.criterionActor.ne),
+                "iternum": self.iternum,
+                "world_config": {"obs_shape": list(self.obs_shape), "encoder": self.config.encoder},
             },
-            save_path
+            self.iternum,
+            replay
         )
-        
-        print ("...done")
-        #  plt.imsave("img.png", np.clip((x_hat[0].detach().cpu().numpy().transpose(1,2,0))/255+0.5, 0, 1))
-
-    #  plt.figure(1)
-    #  #  plt.clf()
-    #  plt.imshow(x_hat[0].detach().cpu().numpy().transpose(1,2,0), cmap='gray')
-    #  #  plt.pause(0.001)
-    #  plt.show()
-
-env.close()
-exit()
\ No newline at end of file
+
+    def run(self):
+        c = self.config
+        handle_sigterm()
+        if self.world is None:
+            self.load()
+        if self.replay is None:
+            self.build_replay()
+            self.start_collection()
+
+        print ("Dataset init")
+        self.sampler.wait_ready() # sleeps until an episode long enough arrives
+        print ("done")
+        if c.prefetch > 0:
+            self.prefetcher = Prefetcher(self.sampler, depth=c.prefetch, device=self.device)
+            self.prefetcher.start()
+        if self.latents is not None:
+            self.refresher = LatentRefresher(
+                self.latents, self.replay, self.world, self.preprocess, c.L, c.refresh_batch,
+                c.latent_max_age, self.world_lock, self.device
+            )
+            self.refresher.version = self.iternum
+            self.refresher.start()
+
+        self.metrics.sink = make_sink(c.metrics_path) if self.rank == 0 else None
+        if c.profile_dir is not None:
+            self.profiler = ProfilerWindow(c.profile_dir, wait=c.profile_wait, active=c.profile_steps)
+        self.metrics.start(self.iternum, counters=self.counters())
+
+        publish_pending = False
+        data_ages = []
+        start = time()
+        try:
+            while True:
+                pbar = tqdm(range(max(1, c.history_size // c.batch)), disable=self.rank != 0)
+                for _ in pbar:
+                    with self.metrics.phase("sample"):
+                        if self.prefetcher is not None: # already on the device
+                            (s, a, r, g), info = self.prefetcher.get()
+                        else:
+                            s, a, r, g = self.sampler.sample()
+                            info = self.sampler.info
+                            if (torch.cuda.is_available()):
+                                s = s.cuda(non_blocking=True)
+                                a = a.cuda(non_blocking=True)
+                                r = r.cuda(non_blocking=True)
+                                g = g.cuda(non_blocking=True)
+                        s = self.preprocess.to_float(s) # only the sampled batch, on the device
+                        if (torch.cuda.is_available()):
+                            torch.cuda.reset_peak_memory_stats()
+                    # updates made since the sampled episodes were collected
+                    data_ages.append(self.iternum - info["versions"])
+
+                    z_sample, h, loss_model, loss_terms = self.train_world_model(s, a, r, g, info)
+                    loss_actor, loss_critic = self.train_actor_critic(z_sample, h)
+
+                    # more actor-critic updates from cached start states
+                    if self.latents is not None:
+                        self.latents.write(info["steps"][:, None] + np.arange(c.L + 1), z_sample, h, self.iternum)
+                        for _ in range(c.actor_critic_updates - 1):
+                            with self.metrics.phase("latent_sample"):
+                                z_start, h_start = self.latents.sample(
+                                    h.shape[0] * h.shape[1], self.replay.episode_first_steps()[0],
+                                    self.iternum, c.latent_max_age, self.device
+                                )
+                            loss_actor, loss_critic = self.train_actor_critic(z_start, h_start)
+
+                    # update target network with critic weights
+                    self.iternum += 1
+                    if not self.iternum % c.target_interval:
+                        if self.world_size > 1: # undo any drift between the critic replicas first
+                            broadcast_modules([self.critic])
+                        with torch.no_grad():
+                            self.target.load_state_dict(self.critic.state_dict())
+
+                    # hand new weights to the collectors, retried next iteration if they are reading
+                    if c.decoupled and (not self.iternum % c.publish_interval or publish_pending):
+                        publish_pending = not self.params.publish({"world": self.world, "actor": self.actor}, self.iternum)
+                    elif self.collector is not None: # shares the learner's models
+                        self.collector.version = self.iternum
+                    if self.refresher is not None:
+                        self.refresher.version = self.iternum
+
+                    if self.profiler is not None:
+                        self.profiler.step()
+
+                    if not self.iternum % c.log_interval:
+                        data_ages = np.concatenate(data_ages)
+                        self.metrics.record(
+                            self.iternum,
+                            counters=self.counters(),
+                            loss_world=loss_model,
+                            **{"loss_world_%s" % k: float(v) for k, v in loss_terms.items()},
+                            loss_actor=loss_actor,
+                            loss_critic=loss_critic,
+                            replay_episodes=self.replay.num_episodes,
+                            replay_steps=self.replay.num_steps,
+                            replay_mb=self.replay.nbytes / 2**20,
+                            data_age_mean=float(data_ages.mean()),
+                            data_age_max=int(data_ages.max()),
+                            last_reward=self.replay.last_episode_reward(),
+                            peak_mem_mb=peak_memory_mb(),
+                            **(self.prefetcher.stats() if self.prefetcher is not None else {}),
+                            **(self.latents.stats(
+                                self.replay.episode_first_steps()[0], self.iternum, c.latent_max_age
+                            ) if self.latents is not None else {}),
+                        )
+                        data_ages = []
+
+                    #  display
+                    pbar.set_postfix(
+                        l_world = loss_model,
+                        l_actor = loss_actor,
+                        l_critic = loss_critic,
+                        len_h = self.replay.num_episodes,
+                        iternum=self.iternum,
+                        last_rew=self.replay.last_episode_reward(),
+                        peak_mem=peak_memory_mb(),
+                    )
+
+                # save once in a while
+                if time() - start > c.save_interval:
+                    start = time()
+                    self.save()
+        finally:
+            self.close()
+
+    def counters(self):
+        # running totals reported as rates
+        counters = {"env_steps": self.replay.collected}
+        if self.refresher is not None:
+            counters["latents_refreshed"] = self.refresher.refreshed
+        return counters
+
+    def close(self):
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+        if self.refresher is not None:
+            self.refresher.stop()
+        if self.profiler is not None:
+            self.profiler.stop()
+        self.metrics.close()
+        try:
+            self.stop_collection()
+        finally:
+            if self.world is not None and self.replay is not None: # keeps what was collected since the last save
+                self.save()
+            self.manager.wait()
@@ -0,0 +1,42 @@
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from dreamerv2.distributed import all_reduce_gradients, broadcast_modules
+
+WORLD_SIZE = 2
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def rank_process(rank, port, out_dir):
+    dist.init_process_group("gloo", init_method="tcp://127.0.0.1:%d" % port, rank=rank, world_size=WORLD_SIZE)
+    try:
+        torch.manual_seed(rank) # different parameters on every rank
+        model = torch.nn.Linear(4, 3)
+        model.weight.grad = torch.full_like(model.weight, rank + 1.0)
+        # bias.grad stays None and counts as zero
+        all_reduce_gradients(model.parameters())
+        broadcast_modules([model])
+        torch.save(
+            {"weight_grad": model.weight.grad, "bias_grad": model.bias.grad, "state": model.state_dict()},
+            "%s/rank-%d.pt" % (out_dir, rank)
+        )
+    finally:
+        dist.destroy_process_group()
+
+def test_all_reduce_and_broadcast(tmp_path):
+    mp.spawn(rank_process, args=(free_port(), str(tmp_path)), nprocs=WORLD_SIZE)
+    results = [torch.load(tmp_path / ("rank-%d.pt" % rank)) for rank in range(WORLD_SIZE)]
+
+    torch.manual_seed(0)
+    expected = torch.nn.Linear(4, 3).state_dict()
+    for r in results:
+        assert torch.equal(r["weight_grad"], torch.full((3, 4), 1.5)) # mean of 1 and 2
+        assert torch.equal(r["bias_grad"], torch.zeros(3))
+        for k, v in expected.items():
+            assert torch.equal(r["state"][k], v) # parameters of rank 0
@@ -0,0 +1,47 @@
+import pytest
+import torch
+
+from dreamerv2 import export
+from dreamerv2.model import WorldModel, Actor
+
+NUM_ACTIONS = 18
+
+@pytest.fixture
+def models():
+    torch.manual_seed(0)
+    return WorldModel(0.995, NUM_ACTIONS), Actor(NUM_ACTIONS)
+
+def observations(world, steps=20, envs=8):
+    return torch.randint(0, 256, (steps, envs, *world.obs_shape), dtype=torch.uint8)
+
+def save_checkpoint(path, world, actor, **world_state):
+    state = dict(world.state_dict(), **world_state)
+    torch.save({"world": state, "actor": actor.state_dict()}, path)
+
+def test_scripted_fp32_parity(models):
+    world, actor = models
+    report = export.check_parity(export.Policy(world, actor), export.export(world, actor), observations(world))
+    assert report["max_error_h"] < 1e-5
+    assert report["max_error_logits"] < 1e-4
+    assert report["action_agreement"] == 1.0
+
+def test_quantized_int8_parity(models):
+    world, actor = models
+    report = export.check_parity(export.Policy(world, actor), export.export(world, actor, quantized=True), observations(world))
+    # an untrained actor has nearly uniform logits, so int8 flips some argmax actions
+    assert report["max_error_h"] < 1e-2
+    assert report["max_error_logits"] < 0.2
+    assert report["action_agreement"] >= 0.6
+
+def test_load_checkpoint_ignores_only_the_decoder(models, tmp_path):
+    world, actor = models
+    path = tmp_path / "checkpoint.chkpt"
+    save_checkpoint(path, world, actor, **{"state_predictor_decoder.0.weight": torch.zeros(3, 3)})
+    loaded, _ = export.load_checkpoint(path)
+    assert torch.equal(loaded.gru.weight_hh, world.gru.weight_hh)
+
+    state = world.state_dict()
+    state["gru.weight_renamed"] = state.pop("gru.weight_hh")
+    torch.save({"world": state, "actor": actor.state_dict()}, path)
+    with pytest.raises(ValueError, match="gru.weight"):
+        export.load_checkpoint(path)
@@ -0,0 +1,73 @@
+import asyncio
+
+import numpy as np
+import pytest
+import torch
+
+from dreamerv2 import model
+from dreamerv2.model import WorldModel, Actor
+from dreamerv2.serving import PolicyServer
+
+NUM_ACTIONS = 18
+STEPS = 5
+
+def argmax_one_hot(logits):
+    return torch.zeros_like(logits).scatter_(-1, logits.argmax(dim=-1, keepdim=True), 1.0)
+
+@pytest.fixture
+def models(monkeypatch):
+    # deterministic posterior, so a session's states only depend on its own observations
+    monkeypatch.setattr(model, "sample_one_hot", argmax_one_hot)
+    torch.manual_seed(0)
+    return WorldModel(0.995, NUM_ACTIONS), Actor(NUM_ACTIONS)
+
+def observations(seed, steps=STEPS):
+    return np.random.default_rng(seed).integers(0, 256, (steps, 128), dtype=np.uint8)
+
+async def client(server, session_id, obs):
+    # one step per observation and the state after each
+    actions, states = [], []
+    for o in obs:
+        actions.append(await server.step(session_id, o))
+        states.append(server.h[server.sessions[session_id]].clone())
+    return actions, states
+
+async def serve(world, actor, sessions, reset=None):
+    """
+    Runs one client per session concurrently. With reset, that session is reset
+    afterwards and steps through its observations again.
+    """
+    server = PolicyServer(world, actor, max_delay=0.05, greedy=True)
+    server.start()
+    try:
+        for session_id in sessions:
+            server.open_session(session_id)
+        results = await asyncio.gather(*(client(server, session_id, obs) for session_id, obs in sessions.items()))
+        results = dict(zip(sessions, results))
+        if reset is not None:
+            server.reset_session(reset)
+            results["reset"] = await client(server, reset, sessions[reset])
+    finally:
+        await server.close()
+    return server, results
+
+def test_requests_are_batched(models):
+    server, _ = asyncio.run(serve(*models, {"a": observations(1), "b": observations(2)}))
+    assert server.requests == 2 * STEPS
+    assert server.batches == STEPS
+
+def test_sessions_keep_separate_state(models):
+    sessions = {"a": observations(1), "b": observations(2)}
+    _, together = asyncio.run(serve(*models, sessions, reset="a"))
+    for session_id, obs in sessions.items():
+        _, alone = asyncio.run(serve(*models, {session_id: obs}))
+        actions, states = together[session_id]
+        assert actions == alone[session_id][0]
+        for h, h_alone in zip(states, alone[session_id][1]):
+            assert torch.allclose(h, h_alone, atol=1e-5)
+
+    # after the reset the session starts over as if it were new
+    actions, states = together["reset"]
+    assert actions == together["a"][0]
+    for h, h_first in zip(states, together["a"][1]):
+        assert torch.allclose(h, h_first, atol=1e-5)